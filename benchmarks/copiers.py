@@ -0,0 +1,206 @@
+"""
+Runs both copiers end to end against shared.fake_google on synthetic directories and
+reports per phase: wall time, CPU time, requests, bytes sent and received by the
+copier, and the peak resident memory of the process so far (fake backend included).
+Every copier and size runs in a process of its own.
+
+Phases: "initial" syncs into empty mailboxes, "unchanged" repeats the full sync,
+"incremental" runs with -I after 1% of the sources changed.
+
+$ python -m benchmarks.copiers --sizes 1000,5000,10000 --targets 10 --save-baseline baseline.json
+$ python -m benchmarks.copiers --sizes 1000,5000,10000 --targets 10 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DOMAIN = 'example.com'
+TARGET_ORG_UNIT = '/targets'
+PHASES = ['initial', 'unchanged', 'incremental']
+METRICS = ['wall_s', 'cpu_s', 'requests', 'bytes_sent', 'bytes_received', 'max_rss_kb']
+COPIERS = {
+    'users': 'gapps_users_to_contacts_group_copier',
+    'calendar': 'gapps_calendar_resources_to_contacts_group_copier',
+}
+LOGGING_CONF = """[loggers]
+keys=root
+[handlers]
+keys=console
+[formatters]
+keys=simple
+[logger_root]
+level=WARNING
+handlers=console
+[handler_console]
+class=StreamHandler
+level=WARNING
+formatter=simple
+args=(sys.stderr,)
+[formatter_simple]
+format=%(asctime)s - %(levelname)s - %(message)s
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,5000,10000",
+        help="comma separated directory sizes (users, or calendar resources for the calendar copier)")
+    parser.add_argument("--targets", type=int, default=10,
+        help="number of target users whose contacts are synced")
+    parser.add_argument("--copiers", default="users,calendar",
+        help="comma separated copiers to run: users, calendar")
+    parser.add_argument("--personal", type=int, default=50,
+        help="contacts of their own in every target mailbox")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="seconds every fake API request takes")
+    parser.add_argument("--baseline", help="compare with results stored in FILE", metavar="FILE")
+    parser.add_argument("--save-baseline", help="store the results in FILE", metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="relative increase of a metric over the baseline reported as a regression")
+    # internal: run one copier at one size, writing the results to a file
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def measure(google, fn):
+    """Runs fn, returning the metrics of what it did."""
+    requests, sent, received = len(google.requests), google.bytes_received, google.bytes_sent
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    fn()
+    wall = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    return {'wall_s': wall,
+        'cpu_s': (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        'requests': len(google.requests) - requests,
+        # from the point of view of the copier
+        'bytes_sent': google.bytes_received - sent,
+        'bytes_received': google.bytes_sent - received,
+        'max_rss_kb': after.ru_maxrss}
+
+def run_child(args):
+    """Runs the phases of one copier at one size in this process."""
+    state_dir = tempfile.mkdtemp(prefix='copier-benchmark-')
+    try:
+        logging_conf = os.path.join(state_dir, 'logging.conf')
+        with open(logging_conf, 'w') as f:
+            f.write(LOGGING_CONF)
+        # options() reads the command line of the copier
+        sys.argv[1:] = ['-c', 'config.conf.template', '-l', logging_conf, '-U', '*',
+            '--user-org-unit', TARGET_ORG_UNIT, '-M', '-D', '-w', str(args.workers)]
+        from importlib import import_module
+        copier = import_module('%s.%s' % (COPIERS[args.child], COPIERS[args.child]))
+        from shared.options import options
+        from shared.fake_google import FakeGoogle, synthetic_users, synthetic_calendar_resources
+
+        o = options()
+        o.domain = DOMAIN
+        o.optout_uri = ''
+        o.my_contacts_id = 'Contacts'
+        o.default_external_id_rel = 'organization'
+        o.rate_limits = ''
+        o.snapshot_file = os.path.join(state_dir, 'snapshot.json.gz')
+        o.contact_cache_dir = os.path.join(state_dir, 'contact_cache')
+        o.journal_file = os.path.join(state_dir, 'journal.json')
+        o.report_file = os.path.join(state_dir, 'report.json')
+        o.discovery_cache_dir = ''
+
+        google = FakeGoogle(DOMAIN, latency=args.latency, seed=1)
+        if args.child == 'users':
+            sources = google.users
+            sources.extend(synthetic_users(args.size - args.targets, DOMAIN))
+        else:
+            o.select_pattern = '%s_*' % DOMAIN
+            o.calendar_resource_feed = 'https://apps-apis.google.com/a/feeds/calendar/resource/2.0/%s/' % DOMAIN
+            sources = google.calendar_resources
+            sources.extend(synthetic_calendar_resources(args.size, DOMAIN))
+        targets = synthetic_users(args.targets, DOMAIN, start=10 ** 6, org_unit=TARGET_ORG_UNIT)
+        google.users.extend(targets)
+        for user in targets:
+            google.add_personal_contacts(user[u'primaryEmail'], args.personal)
+        google.install()
+
+        results = {}
+        results['initial'] = measure(google, copier.main)
+        results['unchanged'] = measure(google, copier.main)
+        for source in sources[1::100]:
+            if args.child == 'users':
+                source[u'organizations'][0][u'title'] = u'Changed'
+            else:
+                source['resourceDescription'] = 'Changed'
+        o.incremental = True
+        results['incremental'] = measure(google, copier.main)
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+    finally:
+        shutil.rmtree(state_dir, True)
+
+def run_all(args):
+    """{"copier/size/phase": metrics} of every copier and size, each run in a child process."""
+    results = {}
+    output = tempfile.NamedTemporaryFile(suffix='.json', delete=False).name
+    try:
+        for copier in args.copiers.split(','):
+            for size in map(int, args.sizes.split(',')):
+                command = [sys.executable, '-m', 'benchmarks.copiers', '--child', copier, '--size', str(size),
+                    '--output', output, '--targets', str(args.targets), '--personal', str(args.personal),
+                    '--workers', str(args.workers), '--latency', str(args.latency)]
+                subprocess.check_call(command)
+                with open(output) as f:
+                    for phase, metrics in json.load(f).items():
+                        results['%s/%d/%s' % (copier, size, phase)] = metrics
+    finally:
+        os.remove(output)
+    return results
+
+def sort_key(key):
+    copier, size, phase = key.split('/')
+    return copier, int(size), PHASES.index(phase)
+
+def report(results, baseline, tolerance):
+    """Prints the results, compared with baseline if any. Returns the regressed metrics."""
+    regressions = []
+    print '%-28s %9s %9s %9s %12s %12s %11s' % ('copier/size/phase', 'wall s', 'cpu s', 'requests',
+        'bytes sent', 'bytes recv', 'max rss kB')
+    for key in sorted(results, key=sort_key):
+        metrics = results[key]
+        print '%-28s %9.2f %9.2f %9d %12d %12d %11d' % tuple([key] + [metrics[metric] for metric in METRICS])
+        if key not in baseline:
+            continue
+        changes = []
+        for metric in METRICS:
+            old, new = baseline[key][metric], metrics[metric]
+            change = (new - old) / float(old) if old else float(new > 0) # anything from nothing counts as +100%
+            changes.append('%+8.0f%%' % (change * 100))
+            if change > tolerance:
+                regressions.append((key, metric, old, new))
+        print '%-28s %s' % ('  vs baseline', ' '.join(changes))
+    return regressions
+
+def main():
+    args = parse_args()
+    if args.child:
+        return run_child(args)
+    results = run_all(args)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    for key, metric, old, new in regressions:
+        print 'REGRESSION %s %s: %s -> %s' % (key, metric, old, new)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the per-target-user "already in group" check of process_target_user before
+and after indexing group members, on synthetic directories.
+
+$ python -m benchmarks.membership_index --sizes 1000,2000,5000,10000
+"""
+import argparse
+import sys
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,2000,5000,10000",
+        help="comma separated directory sizes to measure")
+    parser.add_argument("--legacy-max", type=int, default=2000,
+        help="largest size to run the quadratic legacy check for")
+    return parser.parse_args()
+
+args = parse_args()
+# options() reads the command line of the copier
+sys.argv[1:] = ['-c', 'config.conf.template']
+
+from atom.data import Id
+from gdata.data import ExtendedProperty, Email
+from gdata.contacts.data import ContactEntry
+
+from gapps_users_to_contacts_group_copier.gapps_users_to_contacts_group_copier import get_ldap_id_contact
+from shared.implementation import ContactIndex
+from shared.options import options
+
+def synthetic_members(size):
+    members = []
+    for n in range(size):
+        contact = ContactEntry(id=Id(text='http://www.google.com/m8/feeds/contacts/bench/base/%x' % n))
+        contact.email.append(Email(address='user%d@example.com' % n, primary='true'))
+        contact.extended_property.append(ExtendedProperty(name=options().contact_id_extended_property_name, value=str(n)))
+        contact.extended_property.append(ExtendedProperty(name=options().contact_extended_property_name, value=options().contact_extended_property_value))
+        members.append(contact)
+    return members
+
+def legacy(members, ldap_ids):
+    magic_group_ldaps_set = lambda: filter(None, [ get_ldap_id_contact(contact) for contact in members ])
+    return [ldap_id for ldap_id in ldap_ids if ldap_id not in magic_group_ldaps_set()]
+
+def indexed(members, ldap_ids):
+    index = ContactIndex()
+    for contact in members:
+        index.add(contact, get_ldap_id_contact(contact))
+    return [ldap_id for ldap_id in ldap_ids if ldap_id not in index.by_id]
+
+def timed(fn, *a):
+    start = time.time()
+    fn(*a)
+    return time.time() - start
+
+def main():
+    print '%8s %14s %14s' % ('users', 'legacy (s)', 'indexed (s)')
+    for size in map(int, args.sizes.split(',')):
+        members = synthetic_members(size)
+        # one new user on top of a fully synced group
+        ldap_ids = [str(n) for n in range(size + 1)]
+        legacy_time = '%14.3f' % timed(legacy, members, ldap_ids) if size <= args.legacy_max else '%14s' % '-'
+        print '%8d %s %14.3f' % (size, legacy_time, timed(indexed, members, ldap_ids))
+
+if __name__ == "__main__":
+    main()
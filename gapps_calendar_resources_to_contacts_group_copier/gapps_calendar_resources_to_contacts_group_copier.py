@@ -8,100 +8,160 @@ import sys, copy, time, os.path, logging, logging.config
 from fnmatch import fnmatch
 from operator import attrgetter as get, itemgetter as iget
 from contextlib import closing
+from collections import OrderedDict
+from itertools import chain
 
 DEFAULT_REL = WORK_REL
 
-from shared.google_apis import calendar_resource, contacts, admin, exhaust, Batch
+from shared.google_apis import calendar_resource, contacts, admin
 from shared.dots import compare_object_values, err, dotset, dotget
 from shared.fn import flatmap, filtermap
 from shared.futurice import get_optout_set
-from shared.implementation import get_magic_group, get_group_members, create_magic_group, is_script_contact, is_script_group, undo
+from shared.implementation import (get_magic_group, get_group_members, create_magic_group, is_script_contact, is_script_group, undo, ContactIndex,
+        is_up_to_date, stamp_magic_group, ChangedMembers, get_cached_members, contacts_batch, submitting, contact_emails,
+        add_digest, is_in_sync, stamp_digest, process_targets,)
+from shared.directory import compile_glob, in_org_unit, user_query, list_users
+from shared.snapshot import Delta, record_digest
+from shared.shard import Sharding
+from shared.metrics import run_metrics
+from shared.profiling import profiling
+from shared.contact_cache import ContactCache
+from shared.files import fileloc
 
 os.environ.setdefault('PARSER', 'gapps_calendar_resources_to_contacts_group_copier.options')
 os.environ.setdefault('ROOTDIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), ''))
 from shared.options import options
 
 def resources_to_contacts():
+    try:
+        sharding = Sharding(options().shard, fileloc(options().lease_dir) if options().lease_dir else '',
+            options().lease_window)
+    except ValueError as e:
+        sys.exit(str(e))
+    metrics = run_metrics()
+    metrics.start()
+
     # Get Calendar Resources
-    calendars = calendar_resource(options=options()).get_resource_feed(uri=options().calendar_resource_feed).entry
+    with metrics.phase('directory'):
+        calendars = calendar_resource(options=options()).get_resource_feed(uri=options().calendar_resource_feed).entry
 
     # Select Calendars by options
-    filtered_calendars = filter(lambda cal: \
-        fnmatch(cal.resource_email, options().select_pattern), calendars)
+    is_selected_calendar = compile_glob(options().select_pattern)
+    filtered_calendars = filter(lambda cal: is_selected_calendar(cal.resource_email), calendars)
 
-    # Fetch all domain users
-    all_users = exhaust(admin(options=options()).users().list, dict(domain=options().domain, maxResults=500), 'users')
+    # Fetch domain users, narrowed down server-side where the pattern allows
+    with metrics.phase('directory'):
+        # Get opt-out lists
+        optout_emails_set = set() if not options().undo else get_optout_set(options().optout_uri)
 
-    # Get opt-out lists
-    optout_emails_set = set() if not options().undo else get_optout_set(options().optout_uri)
+        all_users = list_users(admin(options=options()), options().domain,
+                [user_query(options().user_pattern, options().user_org_unit)],
+                'nextPageToken,users(primaryEmail,orgUnitPath)')
 
-    # Select domain users by options
-    filtered_users = filtermap(lambda user: fnmatch(user['primaryEmail'], options().user_pattern) and \
-                unicode(user['primaryEmail']).lower() not in optout_emails_set,
-                iget('primaryEmail'), all_users)
+        # Select domain users by options, paging through the directory within the phase
+        is_target_user = compile_glob(options().user_pattern)
+        filtered_users = filtermap(lambda user: is_target_user(user['primaryEmail']) and \
+                    in_org_unit(user, options().user_org_unit) and \
+                    unicode(user['primaryEmail']).lower() not in optout_emails_set,
+                    iget('primaryEmail'), all_users)
 
     logging.info('Starting Calendar Resource to Contacts Group copy operation. Selection is "%s" (%d calendar(s)) and target is "%s" (%d user(s))',
         options().select_pattern, len(filtered_calendars), options().user_pattern, len(filtered_users))
 
-    process_users(filtered_users, filtered_calendars)
-
-def process_users(filtered_users, filtered_calendars):
-    for target_user in filtered_users:
-        process_user(target_user, filtered_calendars)
-
-def process_user(target_user, filtered_calendars):
-    filtered_calendar_by_email_dict = dict(zip(map(get('resource_email'), filtered_calendars), filtered_calendars))
+    # Compare with the Calendar Resources as seen by the previous run
+    delta = Delta(fileloc(options().snapshot_file),
+        dict((cal.resource_email.lower(), record_digest(calendar_resource_record(cal))) for cal in filtered_calendars),
+        salt=record_digest([options().family_name, options().contact_extended_property_name, options().contact_extended_property_value,
+            options().contact_digest_extended_property_name, options().my_contacts, options().delete_old]))
+    logging.info('Calendar Resource changes since previous run: %d added, %d changed, %d removed',
+        len(delta.added), len(delta.changed), len(delta.removed))
+
+    with metrics.phase('templates'):
+        contact_templates = build_contact_templates(filtered_calendars)
+    process_targets(filtered_users,
+        lambda target_user, journal: process_user(target_user, contact_templates, delta, journal),
+        delta, record_digest([delta.fingerprint, sorted(contact_templates), options().undo]), sharding,
+        'calendar_resources_to_contacts')
+
+def process_user(target_user, contact_templates, delta=None, journal=None):
+    """
+    Sync the contacts of one target user. Returns the updated stamp of the group
+    stamped with the fingerprint of delta, or None if something failed or there is no delta.
+    In incremental mode only the contacts of changed Calendar Resources are diffed,
+    and nothing at all if the group has not changed since the previous run stamped it.
+    Group members are then read from the contact cache, only those changed on the server are fetched.
+    """
     contacts_client = contacts(email=target_user, options=options())
+    if journal:
+        contacts_client.batch_progress = journal.progress(target_user)
+    with submitting(contacts_client):
+        return sync_user(contacts_client, target_user, contact_templates, delta)
 
+def sync_user(contacts_client, target_user, contact_templates, delta):
+    metrics = run_metrics()
     if options().undo:
         undo(contacts_client, target_user, ContactsFeed)
         return
 
-    # Get Contacts Groups for user
-    groups = contacts_client.get_groups().entry
+    incremental = delta is not None and options().incremental
+    changed_emails = delta.changed_keys(target_user) if incremental else None
+    cache = ContactCache(fileloc(options().contact_cache_dir), target_user, delta.salt) if delta is not None else None
+
+    with metrics.phase('groups'):
+        # Get Contacts Groups for user
+        groups = contacts_client.get_groups().entry
 
-    # Find Contact Group by extended property
-    magic_group = get_magic_group(groups) or create_magic_group(contacts_client)
-    magic_group_members = get_group_members(contacts_client, magic_group)
-    magic_group_emails_set = map(get('address'), flatmap(get('email'), magic_group_members))
+        # Find Contact Group by extended property
+        magic_group = get_magic_group(groups) or create_magic_group(contacts_client)
+
+    if incremental and is_up_to_date(magic_group, delta.fingerprint, delta.group_stamp(target_user)):
+        logging.info('%s: Group "%s" is up to date', target_user, magic_group.title.text)
+        return magic_group.updated.text
 
     # Find "My Contacts" group in Contacts
     my_contacts_group = next(iter(
         filter(lambda group: group.system_group and group.system_group.id == options().my_contacts_id, groups)), None)
 
-    logging.info('%s: Using group called "%s" with %d members and ID %s',
-        target_user, magic_group.title.text, len(magic_group_members),
-        magic_group.id.text)
-
-    # Add new Calendar Resources as Contacts
-    with closing(Batch(contacts_client, ContactsFeed)) as batch:
-        for cal in filter(lambda x: \
-                x.resource_email not in magic_group_emails_set, filtered_calendars):
-            new_contact = calendar_resource_to_contact(cal)
-
-            # Add Contact to the relevant groups
-            new_contact.group_membership_info.append(GroupMembershipInfo(href=magic_group.id.text))
-            if options().my_contacts and my_contacts_group:
-                new_contact.group_membership_info.append(GroupMembershipInfo(href=my_contacts_group.id.text))
-
-            # Set Contact extended property
-            extprop = ExtendedProperty()
-            extprop.name = options().contact_extended_property_name
-            extprop.value = options().contact_extended_property_value
-            new_contact.extended_property.append(extprop)
-
-            logging.debug('%s: Creating contact "%s"', target_user,
-                    new_contact.name.full_name.text)
-            batch.put('add_insert', new_contact)
-
-    # Sync data for existing Calendar Resources that were added by the script. Remove those that have been deleted
-    with closing(Batch(contacts_client, ContactsFeed)) as batch:
-        for existing_contact in filter(is_script_contact, magic_group_members):
-            calendar_resource_to_copy = get_value_by_contact_email(filtered_calendar_by_email_dict, existing_contact)
-
-            if calendar_resource_to_copy:
-                calendar_contact = calendar_resource_to_contact(calendar_resource_to_copy)
-                if sync_contact(calendar_contact, existing_contact):
+    logging.info('%s: Using group called "%s" with ID %s',
+        target_user, magic_group.title.text, magic_group.id.text)
+
+    # Sync data for existing Calendar Resources that were added by the script. Remove those that have been deleted.
+    # Changes are held back until all pages of the group have been read.
+    # With a cache of the previous run only members changed since are fetched, in full.
+    magic_group_members = ContactIndex()
+    from_cache = changed_emails is not None and cache.updated is not None
+    with metrics.phase('members'):
+        if from_cache:
+            members = ChangedMembers(contacts_client, magic_group, cache)
+            cached_members = get_cached_members(contacts_client, cache, magic_group_members, delta.records)
+            changed_emails = None # every fetched member gets diffed
+        else:
+            members = get_group_members(contacts_client, magic_group)
+            cached_members = []
+            if cache is not None:
+                cache.clear()
+    with closing(contacts_batch(contacts_client, hold=True)) as batch:
+        for existing_contact in metrics.timed('members', chain(members, cached_members)):
+            magic_group_members.add(existing_contact)
+            if not is_script_contact(existing_contact):
+                if cache is not None:
+                    cache.put(existing_contact)
+                continue
+
+            calendar_email = get_contact_email(contact_templates, existing_contact)
+            if cache is not None:
+                cache.put(existing_contact, calendar_email or next(iter(contact_emails(existing_contact)), None),
+                    delta.records.get(calendar_email))
+
+            if calendar_email:
+                if changed_emails is not None and calendar_email not in changed_emails:
+                    continue # unchanged since the previous run
+                template = contact_templates[calendar_email]
+                if is_in_sync(existing_contact, template, cache):
+                    continue # synced to the template already, and not modified since
+                with metrics.phase('diff'):
+                    modified = stamp_digest(existing_contact, template, bool(sync_contact(template, existing_contact)))
+                if modified:
                     logging.info('%s: Modifying contact "%s" with ID %s',
                         target_user, existing_contact.name.full_name.text, existing_contact.id.text)
                     batch.put('add_update', existing_contact)
@@ -109,11 +169,35 @@ def process_user(target_user, filtered_calendars):
                 logging.info('%s: Removing surplus auto-generated contact "%s" with ID %s',
                     target_user, existing_contact.name.full_name.text, existing_contact.id.text)
                 batch.put('add_delete', existing_contact)
+    failed = batch.failed
+
+    logging.info('%s: Group "%s" has %d member(s)',
+        target_user, magic_group.title.text, len(magic_group_members))
+
+    # Add new Calendar Resources as Contacts of the relevant groups
+    group_hrefs = [magic_group.id.text]
+    if options().my_contacts and my_contacts_group:
+        group_hrefs.append(my_contacts_group.id.text)
+    with closing(contacts_batch(contacts_client)) as batch:
+        with metrics.phase('insert'):
+            for email, template in contact_templates.iteritems():
+                if email not in magic_group_members.by_email:
+                    logging.debug('%s: Creating contact "%s"', target_user,
+                            template.name.full_name.text)
+                    batch.put_template(template, group_hrefs)
+    failed += batch.failed
+
+    if delta is None or failed:
+        return None
+    with metrics.phase('stamp'):
+        cache.save(members.updated)
+        return stamp_magic_group(contacts_client, magic_group, delta.fingerprint).updated.text
 
+SYNC_KEYS = ['content','name','name.given_name','name.family_name','name.full_name']
 
 def sync_contact(source, target):
     """Copies data from source contact to target contact and returns changes, if target was modified."""
-    keys = ['content','name','name.given_name','name.family_name','name.full_name']
+    keys = SYNC_KEYS
     changes = compare_object_values(source, target, keys,
             cmp=err(lambda x,y: x.text==y.text),
             cmp_value=lambda x: '{}.text'.format(x),
@@ -123,6 +207,29 @@ def sync_contact(source, target):
         dotset(target, k, dotget(source, k))
     return changes
 
+def build_contact_templates(calendars):
+    """
+    Convert each Calendar Resource into a Contact once per run, keyed by lower-case email.
+    Templates are shared by all target users and must not be modified.
+    """
+    templates = OrderedDict()
+    for cal in calendars:
+        template = calendar_resource_to_contact(cal)
+
+        # Set Contact extended property
+        extprop = ExtendedProperty()
+        extprop.name = options().contact_extended_property_name
+        extprop.value = options().contact_extended_property_value
+        template.extended_property.append(extprop)
+        add_digest(template, sync_fields(template))
+
+        templates[cal.resource_email.lower()] = template
+    return templates
+
+def sync_fields(contact):
+    """The values of the fields that sync_contact() copies from contact."""
+    return [getattr(dotget(contact, key), 'text', None) for key in SYNC_KEYS if key != 'name']
+
 def calendar_resource_to_contact(calendar):
     """Converts a Calendar Resource to a Contact."""
     contact = ContactEntry()
@@ -135,8 +242,12 @@ def calendar_resource_to_contact(calendar):
         primary='true', display_name=calendar.resource_common_name, rel=DEFAULT_REL))
     return contact
 
-def get_value_by_contact_email(email_dict, contact):
-    """Resolve Contact to email key in email_dict and return the first matching value."""
+def calendar_resource_record(calendar):
+    """The Calendar Resource fields that end up in its Contact."""
+    return [calendar.resource_email, calendar.resource_common_name, calendar.resource_description]
+
+def get_contact_email(email_dict, contact):
+    """Resolve Contact to the first matching email key in email_dict."""
 
     matching_emails = filter(
         lambda email: email.address and email.address.lower() in email_dict,
@@ -152,10 +263,11 @@ def get_value_by_contact_email(email_dict, contact):
     if not contact_emails:
         contact_emails = matching_emails
 
-    return email_dict[contact_emails[0].address.lower()]
+    return contact_emails[0].address.lower()
 
 def main():
-    resources_to_contacts()
+    with profiling(options().profile, run_metrics()):
+        resources_to_contacts()
     
 if __name__ == "__main__":
     main()
@@ -18,13 +18,24 @@ from fnmatch import fnmatch
 import json
 import urllib
 from operator import attrgetter as get, itemgetter as iget
+from itertools import chain
 from contextlib import closing
+from collections import OrderedDict
 
 from shared.futurice import get_optout_set
-from shared.google_apis import contacts, admin, exhaust, Batch
+from shared.google_apis import contacts, admin
+from shared.directory import compile_glob, in_org_unit, user_query, list_users
+from shared.snapshot import Delta, record_digest
+from shared.shard import Sharding
+from shared.metrics import run_metrics
+from shared.profiling import profiling
+from shared.contact_cache import ContactCache
+from shared.files import fileloc
 from shared.implementation import (get_magic_group, get_group_members,
         create_magic_group, is_script_contact, is_script_group, undo,
-        is_renamed_contact,)
+        is_renamed_contact, get_extended_property, ContactIndex,
+        is_up_to_date, stamp_magic_group, ChangedMembers, get_cached_members, contacts_batch, submitting,
+        add_digest, is_in_sync, stamp_digest, process_targets,)
 
 # Set of those Contact field relation values that are overwritten by the script
 SYNC_ORG_RELS = set([WORK_REL, MOBILE_REL])
@@ -33,6 +44,15 @@ SYNC_ORG_LABELS = set(["Employee ID"])
 
 DEFAULT_REL = WORK_REL
 
+# Options that change the contacts built from the same directory data
+CONTACT_SETTINGS = ['add_aliases', 'add_other_emails', 'organization_name', 'base64_encoding',
+        'default_external_id_rel', 'contact_id_extended_property_name',
+        'contact_extended_property_name', 'contact_extended_property_value', 'contact_digest_extended_property_name',
+        'my_contacts', 'delete_old', 'rename_old']
+
+# Partial response of users.list: only the fields read by select_users and json_to_contact_object
+USER_FIELDS = 'nextPageToken,users(primaryEmail,orgUnitPath,name,phones,externalIds,organizations,addresses,ims,emails,aliases,nonEditableAliases)'
+
 os.environ.setdefault('PARSER', 'gapps_users_to_contacts_group_copier.options')
 os.environ.setdefault('ROOTDIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), ''))
 from shared.options import options
@@ -61,28 +81,30 @@ def get_ldap_id_json(user):
             )), None)
 
 def get_ldap_id_contact(contact):
-    return next(iter([extprop.value for extprop in contact.extended_property \
-            if extprop.name == options().contact_id_extended_property_name]), None)
+    return get_extended_property(contact, options().contact_id_extended_property_name)
 
 def select_users():
     users_to_copy = []
     target_user_emails = []
 
+    is_target_user = compile_glob(options().user_pattern)
+    is_selected_user = compile_glob(options().select_pattern)
+
     def grab(user):
-        if fnmatch(user[u'primaryEmail'], options().user_pattern):
+        if is_target_user(user[u'primaryEmail']) and in_org_unit(user, options().user_org_unit):
             target_user_emails.append(user[u'primaryEmail'])
 
-        if fnmatch(user[u'primaryEmail'], options().select_pattern) and \
+        if is_selected_user(user[u'primaryEmail']) and \
             (not options().phone or ( \
                 u'phones' in user and \
                 any([ u'value' in phone and phone[u'value'] for phone in user[u'phones'] ]) ) \
             ) and get_ldap_id_json(user):
             users_to_copy.append(user)
 
-    users = exhaust(
-        admin(options=options()).users().list,
-        dict(domain=options().domain, maxResults=500),
-        'users')
+    # Only list the part of the directory that the patterns can match
+    users = list_users(admin(options=options()), options().domain,
+        [user_query(options().user_pattern, options().user_org_unit), user_query(options().select_pattern)],
+        USER_FIELDS)
     filter(grab, users)
 
     return (users_to_copy, target_user_emails)
@@ -220,9 +242,9 @@ def json_to_im_object(json):
         if json[u'protocol'] == u'custom_protocol':
             if u'customProtocol' in json:
                 im_object.protocol = json[u'customProtocol']
-            elif json[u'protocol'] in protocol_mapper:
-                im_object.protocol = protocol_mapper[json[u'protocol']]
-            else: im_object.protocol = json[u'protocol']
+        elif json[u'protocol'] in protocol_mapper:
+            im_object.protocol = protocol_mapper[json[u'protocol']]
+        else: im_object.protocol = json[u'protocol']
 
     if u'primary' in json and json[u'primary']: im_object.primary = "true"
     im_object.address = json[u'im']
@@ -304,6 +326,40 @@ def json_to_contact_object(json):
 
     return new_contact
 
+def build_contact_templates(users_to_copy):
+    """
+    Convert each user to copy into a ContactEntry once per run, keyed by LDAP ID.
+    Templates are shared by all target users and must not be modified:
+    Batch.put_template() inserts them, sync_contact() only reads them.
+    """
+    templates = OrderedDict()
+    for user_to_copy in users_to_copy:
+        ldap_id = get_ldap_id_json(user_to_copy)
+        template = json_to_contact_object(user_to_copy)
+        template.extended_property.append(ExtendedProperty(name=options().contact_id_extended_property_name, value=ldap_id))
+        template.extended_property.append(ExtendedProperty(name=options().contact_extended_property_name, value=options().contact_extended_property_value))
+        add_digest(template, sync_fields(template))
+        templates[ldap_id] = template
+    return templates
+
+def im_uri(im):
+    """An IM as protocol://address, also for a custom IM that lacks either."""
+    return (im.protocol or '') + "://" + (im.address or '')
+
+def sync_fields(contact):
+    """The values of the fields that sync_contact() copies from contact, in a canonical form."""
+    text = lambda element: element.text if element is not None else None
+    name = contact.name
+    org = contact.organization
+    return [text(contact.content),
+        name and [text(name.given_name), text(name.family_name), text(name.full_name)],
+        org and [text(org.name), text(org.title), text(org.department), text(org.symbol), org.rel, org.label],
+        sorted(email.address for email in contact.email if is_sync_field(email)),
+        sorted([phone_number.text, phone_number.rel] for phone_number in contact.phone_number if is_sync_field(phone_number)),
+        sorted(external_id.value for external_id in contact.external_id if is_sync_field(external_id)),
+        sorted(address.text for address in contact.postal_address if is_sync_field(address)),
+        sorted(im_uri(im) for im in contact.im if is_sync_field(im))]
+
 def sync_contact(source, target):
     """Copies data from source contact to target contact and returns True if target was modified."""
 
@@ -438,8 +494,8 @@ def sync_contact(source, target):
             target.postal_address.extend(source_sync_addresses)
 
     # IMs
-    source_sync_ims = set([ im.protocol + "://" + im.address for im in source.im if is_sync_field(im) ])
-    target_sync_ims = set([ im.protocol + "://" + im.address for im in target.im if is_sync_field(im) ])
+    source_sync_ims = set([ im_uri(im) for im in source.im if is_sync_field(im) ])
+    target_sync_ims = set([ im_uri(im) for im in target.im if is_sync_field(im) ])
     if source_sync_ims != target_sync_ims:
         modified = True
         # There can be only one primary IM. Prefer user's choice.
@@ -505,115 +561,180 @@ def get_value_by_contact_email(email_dict, contact):
 
     return email_dict[contact_emails[0].address.lower()]
 
-def process_target_user(target_user_email, users_to_copy, user_to_copy_by_ldap_dict):
+def process_target_user(target_user_email, contact_templates, delta=None, journal=None):
+    """
+    Sync the contacts of one target user. Returns the updated stamp of the group
+    stamped with the fingerprint of delta, or None if something failed or there is no delta.
+    In incremental mode only the contacts of changed sources are diffed, and nothing
+    at all if the group has not changed since the previous run stamped it. Group members
+    are then read from the contact cache, only those changed on the server are fetched.
+    """
     contacts_client = contacts(email=target_user_email, options=options())
+    if journal:
+        contacts_client.batch_progress = journal.progress(target_user_email)
+    with submitting(contacts_client):
+        return sync_target_user(contacts_client, target_user_email, contact_templates, delta)
 
+def sync_target_user(contacts_client, target_user_email, contact_templates, delta):
+    metrics = run_metrics()
     if options().undo:
         undo(contacts_client, target_user_email, ContactsFeed)
         return
 
-    users_groups = contacts_client.get_groups().entry
+    incremental = delta is not None and options().incremental and not options().delete_contacts
+    changed_ldap_ids = delta.changed_keys(target_user_email) if incremental else None
+    cache = ContactCache(fileloc(options().contact_cache_dir), target_user_email, delta.salt) if delta is not None else None
+
+    with metrics.phase('groups'):
+        users_groups = contacts_client.get_groups().entry
+
+        # Find group by extended property
+        magic_group = get_magic_group(users_groups) or create_magic_group(contacts_client)
 
-    # Find group by extended property
-    magic_group = get_magic_group(users_groups) or create_magic_group(contacts_client)
-    magic_group_members = get_group_members(contacts_client, magic_group)
-    magic_group_ldaps_set = lambda: filter(None, [ get_ldap_id_contact(contact) for contact in magic_group_members ])
+    if incremental and is_up_to_date(magic_group, delta.fingerprint, delta.group_stamp(target_user_email)):
+        logging.info('%s: Group "%s" is up to date', target_user_email, magic_group.title.text)
+        return magic_group.updated.text
 
     # Find "My Contacts" group in Contacts
     my_contacts_group = next(iter(
         filter(lambda group: group.system_group and group.system_group.id == options().my_contacts_id, users_groups)), None)
 
-    logging.info('%s: Using group called "%s" with %d members and ID %s',
-        target_user_email, magic_group.title.text,
-        len(magic_group_members), magic_group.id.text)
+    logging.info('%s: Using group called "%s" with ID %s',
+        target_user_email, magic_group.title.text, magic_group.id.text)
+
+    # Walk through the group members page by page. Changes are held back until the
+    # whole group has been read, so that they do not shift the pages still to come.
+    # With a cache of the previous run only members changed since are fetched, in full.
+    magic_group_members = ContactIndex()
+    from_cache = changed_ldap_ids is not None and cache.updated is not None
+    with metrics.phase('members'):
+        if from_cache:
+            members = ChangedMembers(contacts_client, magic_group, cache)
+            cached_members = get_cached_members(contacts_client, cache, magic_group_members, delta.records)
+            changed_ldap_ids = None # every fetched member gets diffed
+        else:
+            members = get_group_members(contacts_client, magic_group)
+            cached_members = []
+            if cache is not None:
+                cache.clear()
+    with closing(contacts_batch(contacts_client, hold=True)) as batch:
+        for existing_contact in metrics.timed('members', chain(members, cached_members)):
+            # Check dangling entries in scripted group (extended_property only held 'google_apps_sync' Employee ID)
+            if not is_script_contact(existing_contact):
+                logging.info('%s: Removing dangling contact "%s" with ID %s',
+                            target_user_email, existing_contact.name.full_name.text, existing_contact.id.text)
+                batch.put('add_delete', existing_contact)
+                continue
 
-    # remove all existing contacts
-    if options().delete_contacts:
-        with closing(Batch(contacts_client, ContactsFeed)) as batch:
-            for existing_contact in filter(is_script_contact, magic_group_members):
+            # remove all existing contacts
+            if options().delete_contacts:
                 logging.info('%s: Removing contact "%s" with ID %s', target_user_email, existing_contact.name.full_name.text, existing_contact.id.text)
                 batch.put('add_delete', existing_contact)
+                continue
+
+            ldap_id = get_ldap_id_contact(existing_contact)
+            magic_group_members.add(existing_contact, ldap_id)
+            if cache is not None:
+                cache.put(existing_contact, ldap_id, delta.records.get(ldap_id))
+            if changed_ldap_ids is not None and ldap_id in contact_templates and ldap_id not in changed_ldap_ids:
+                continue # unchanged in the directory since the previous run
+            with metrics.phase('diff'):
+                sync_existing_contact(target_user_email, existing_contact, ldap_id, contact_templates, batch, cache)
+    failed = batch.failed
+
+    logging.info('%s: Group "%s" has %d script-managed member(s)',
+        target_user_email, magic_group.title.text, len(magic_group_members))
+
+    # Add new users (not already in the group) as contacts of the relevant groups
+    group_hrefs = [magic_group.id.text]
+    if options().my_contacts and my_contacts_group:
+        group_hrefs.append(my_contacts_group.id.text)
+    with closing(contacts_batch(contacts_client)) as batch:
+        with metrics.phase('insert'):
+            for ldap_id, template in contact_templates.iteritems():
+                if ldap_id not in magic_group_members.by_id:
+                    logging.debug('%s: Creating contact "%s"',
+                        target_user_email, template.name.full_name.text)
+                    batch.put_template(template, group_hrefs)
+    failed += batch.failed
+
+    if delta is None or failed:
+        return None
+    with metrics.phase('stamp'):
+        cache.save(members.updated)
+        return stamp_magic_group(contacts_client, magic_group, delta.fingerprint).updated.text
+
+def sync_existing_contact(target_user_email, existing_contact, ldap_id, contact_templates, batch, cache=None):
+    """Sync data for an existing contact that was added by the script, or remove it if the user has been deleted."""
+    if ldap_id in contact_templates:
+        modified = False
+
+        if options().rename_old and is_renamed_contact(existing_contact):
+            # Remove renamed flag
+            remove_suffix(existing_contact)
+            modified = True
 
-    # Check dangling entries in scripted group (extended_property only held 'google_apps_sync' Employee ID)
-    with closing(Batch(contacts_client, ContactsFeed)) as batch:
-        for dangling_contact in filter(lambda contact: not is_script_contact(contact), magic_group_members):
-            logging.info('%s: Removing dangling contact "%s" with ID %s',
-                        target_user_email, dangling_contact.name.full_name.text, dangling_contact.id.text)
-            batch.put('add_delete', dangling_contact)
-
-    # Add new users (not already in the group) as contacts
-    with closing(Batch(contacts_client, ContactsFeed)) as batch:
-        for user_to_copy in users_to_copy:
-            if get_ldap_id_json(user_to_copy) not in magic_group_ldaps_set():
-                new_contact = json_to_contact_object(user_to_copy)
-
-                # Add the relevant groups
-                new_contact.group_membership_info.append(GroupMembershipInfo(href=magic_group.id.text))
-                if options().my_contacts and my_contacts_group:
-                    new_contact.group_membership_info.append(GroupMembershipInfo(href=my_contacts_group.id.text))
-
-                # Set extended properties
-                new_contact.extended_property.append(ExtendedProperty(name=options().contact_id_extended_property_name, value=get_ldap_id_json(user_to_copy)))
-                new_contact.extended_property.append(ExtendedProperty(name=options().contact_extended_property_name, value=options().contact_extended_property_value))
-
-                logging.debug('%s: Creating contact "%s"',
-                    target_user_email, new_contact.name.full_name.text)
-                batch.put('add_insert', new_contact)
-
-    # Sync data for existing contacts that were added by the script and remove those that have been deleted
-    with closing(Batch(contacts_client, ContactsFeed)) as batch:
-        for existing_contact in filter(is_script_contact, magic_group_members):
-            if get_ldap_id_contact(existing_contact) in user_to_copy_by_ldap_dict:
-                user_to_copy = user_to_copy_by_ldap_dict[get_ldap_id_contact(existing_contact)]
-                modified = False
-
-                if options().rename_old and is_renamed_contact(existing_contact):
-                    # Remove renamed flag
-                    remove_suffix(existing_contact)
-                    modified = True
-
-                # Sync data
-                dir_contact = json_to_contact_object(user_to_copy)
-                modified = sync_contact(dir_contact, existing_contact) or modified
-
-                if modified:
-                    logging.info('%s: Modifying contact "%s" with ID %s',
-                        target_user_email, existing_contact.name.full_name.text, existing_contact.id.text)
-                    batch.put('add_update', existing_contact)
-            else:
-                if options().delete_old:
-                    logging.info('%s: Removing surplus auto-generated contact "%s" with ID %s',
-                        target_user_email, existing_contact.name.full_name.text, existing_contact.id.text)
-                    batch.put('add_delete', existing_contact)
-                elif options().rename_old and not is_renamed_contact(existing_contact):
-                    old_name = existing_contact.name.full_name.text
-                    add_suffix(existing_contact)
-                    logging.info('%s: Renaming surplus auto-generated contact "%s" to "%s" with ID %s',
-                        target_user_email, old_name, existing_contact.name.full_name.text, existing_contact.id.text)
-                    batch.put('add_update', existing_contact)
+        # Sync data, unless the contact carries the digest of the data already
+        template = contact_templates[ldap_id]
+        if not is_in_sync(existing_contact, template, cache):
+            modified = stamp_digest(existing_contact, template, sync_contact(template, existing_contact)) or modified
+
+        if modified:
+            logging.info('%s: Modifying contact "%s" with ID %s',
+                target_user_email, existing_contact.name.full_name.text, existing_contact.id.text)
+            batch.put('add_update', existing_contact)
+    else:
+        if options().delete_old:
+            logging.info('%s: Removing surplus auto-generated contact "%s" with ID %s',
+                target_user_email, existing_contact.name.full_name.text, existing_contact.id.text)
+            batch.put('add_delete', existing_contact)
+        elif options().rename_old and not is_renamed_contact(existing_contact):
+            old_name = existing_contact.name.full_name.text
+            add_suffix(existing_contact)
+            logging.info('%s: Renaming surplus auto-generated contact "%s" to "%s" with ID %s',
+                target_user_email, old_name, existing_contact.name.full_name.text, existing_contact.id.text)
+            batch.put('add_update', existing_contact, outcome='renamed')
 
 #
 # Main routine:
 #
 
 def main():
-    main_logging()
+    with profiling(options().profile, run_metrics()):
+        main_logging()
 
 def main_logging():
     if options().delete_old and options().rename_old:
         sys.exit("Conflicting options detected, aborting")
-
-    optout_emails_set = get_optout_set(options().optout_uri)
-
-    users_to_copy, target_user_emails = select_users()
+    try:
+        sharding = Sharding(options().shard, fileloc(options().lease_dir) if options().lease_dir else '',
+            options().lease_window)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    metrics = run_metrics()
+    metrics.start()
+
+    with metrics.phase('directory'):
+        optout_emails_set = get_optout_set(options().optout_uri)
+        users_to_copy, target_user_emails = select_users()
     target_user_emails = filter(lambda email: email.lower() not in optout_emails_set, target_user_emails)
-    user_to_copy_by_ldap_dict = dict(zip(map(get_ldap_id_json, users_to_copy), users_to_copy))
+    with metrics.phase('templates'):
+        contact_templates = build_contact_templates(users_to_copy)
+
+    # Compare with the directory as seen by the previous run
+    delta = Delta(fileloc(options().snapshot_file),
+        dict((get_ldap_id_json(user), record_digest(user)) for user in users_to_copy),
+        salt=record_digest([getattr(options(), key, None) for key in CONTACT_SETTINGS]))
+    logging.info('Directory changes since previous run: %d added, %d changed, %d removed user(s)',
+        len(delta.added), len(delta.changed), len(delta.removed))
 
     logging.info('Starting Directory to Contacts Group copy operation. Selection is "%s" (%d user(s)) and target is "%s" (%d user(s))',
         options().select_pattern, len(users_to_copy), options().user_pattern, len(target_user_emails))
 
-    for target_user_email in target_user_emails:
-        process_target_user(target_user_email, users_to_copy, user_to_copy_by_ldap_dict)
+    process_targets(target_user_emails,
+        lambda target_user_email, journal: process_target_user(target_user_email, contact_templates, delta, journal),
+        delta, record_digest([delta.fingerprint, options().undo]), sharding, 'users_to_contacts')
 
 if __name__ == "__main__":
     main()
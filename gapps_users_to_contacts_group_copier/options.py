@@ -23,6 +23,12 @@ def parse_options():
         help="copy contacts to all users whose email address matches GLOB",
         metavar="GLOB")
 
+    parser.add_argument(
+        "--user-org-unit",
+        dest="user_org_unit",
+        help="copy contacts only to users in organizational unit PATH (and its sub-units)",
+        metavar="PATH")
+
     parser.add_argument(
         "-G", "--group",
         dest="group",
@@ -83,6 +89,45 @@ def parse_options():
         default=False,
         help="remove all groups and contacts added by this script [dangerous]")
 
+    parser.add_argument(
+        "-I", "--incremental",
+        dest="incremental",
+        action="store_true",
+        default=False,
+        help="only compare contacts whose source changed since the previous run, for users that run completed")
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        default=False,
+        help="continue an interrupted run, skipping the target users it completed")
+
+    parser.add_argument(
+        "--deadline",
+        dest="deadline",
+        help="start no target user that would not finish by TIME (HH:MM, or minutes from now), "
+             "the rest are synced first by the next run",
+        metavar="TIME")
+
+    parser.add_argument(
+        "--shard",
+        dest="shard",
+        help="sync only the target users in shard I of N (0 <= I < N), by hash of their email",
+        metavar="I/N")
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="write CPU, wall-clock and memory profiles of the run to DIR",
+        metavar="DIR")
+
+    parser.add_argument(
+        "-w", "--workers",
+        dest="workers",
+        help="process up to N target users concurrently",
+        metavar="N")
+
     parser.add_argument(
         "-c", "--config",
         dest="config",
@@ -0,0 +1,44 @@
+import os
+import urllib
+
+from shared.snapshot import SNAPSHOT_VERSION, read_json, write_json
+from shared.implementation import contact_emails
+
+"""
+Group members of one target user as of their previous successful run, stored as gzipped JSON:
+{"version": 2, "salt": "...", "updated": server time, "contacts": {id: [etag, key, emails, digest]}}
+key identifies the source of a script-managed contact (None for other members) and
+digest is the source record digest the contact was synced to.
+"""
+
+def cache_path(cache_dir, target_user):
+    return os.path.join(cache_dir, urllib.quote(target_user.lower(), '@') + '.json.gz')
+
+class ContactCache(object):
+    def __init__(self, cache_dir, target_user, salt=''):
+        self.path = cache_path(cache_dir, target_user)
+        self.salt = salt
+        data = read_json(self.path)
+        if not data or data.get('version') != SNAPSHOT_VERSION or data.get('salt') != salt:
+            data = {'updated': None, 'contacts': {}}
+        self.updated = data['updated']
+        self.contacts = data['contacts']
+        # ETags as of the previous run, kept when the contacts are cleared or put again
+        self.etags = dict((contact_id, entry[0]) for contact_id, entry in self.contacts.iteritems())
+    def clear(self):
+        self.updated = None
+        self.contacts = {}
+    def put(self, contact, key=None, digest=None):
+        self.contacts[contact.id.text] = [contact.etag, key, contact_emails(contact), digest]
+    def is_unmodified(self, contact):
+        """Whether contact has not been modified since the previous run saw it."""
+        return contact.etag is not None and self.etags.get(contact.id.text) == contact.etag
+    def discard(self, contact_id):
+        self.contacts.pop(contact_id, None)
+    def save(self, updated):
+        """Stores the cache as of server time `updated`, from which the next run fetches changes."""
+        self.updated = updated
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        write_json(self.path, {'version': SNAPSHOT_VERSION, 'salt': self.salt,
+            'updated': updated, 'contacts': self.contacts})
@@ -0,0 +1,74 @@
+import re
+from fnmatch import translate
+
+from shared.google_apis import exhaust
+
+"""
+Admin SDK Directory user selection
+https://developers.google.com/admin-sdk/directory/v1/guides/search-users
+"""
+GLOB_CHARS = re.compile(r'[*?[]')
+# prefixes that can go unquoted before the * of an email query
+PLAIN_PREFIX = re.compile(r'^[\w.+-]+$')
+
+def compile_glob(pattern):
+    """Precompiled equivalent of fnmatch(name, pattern)."""
+    return re.compile(translate(pattern)).match
+
+def in_org_unit(user, org_unit):
+    """Whether the user is in org_unit or one of its sub-units (always True without org_unit)."""
+    if not org_unit:
+        return True
+    path = user.get('orgUnitPath', '')
+    return path == org_unit or path.startswith(org_unit.rstrip('/') + '/')
+
+def quote(value):
+    """A users.list query value in single quotes, with quotes and backslashes escaped."""
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+def user_query(pattern, org_unit=None):
+    """
+    users.list parameters narrowing the listing to (a superset of) the users whose email
+    matches the glob pattern and who are in org_unit, or None if only the whole domain will do.
+    """
+    params = {}
+    query = []
+    if pattern and '@' in pattern:
+        local, domain = pattern.rsplit('@', 1)
+        if not GLOB_CHARS.search(domain):
+            params['domain'] = domain
+            prefix = GLOB_CHARS.split(local)[0]
+            if prefix == local:
+                query.append("email:%s" % quote(pattern))
+            elif PLAIN_PREFIX.match(prefix):
+                query.append("email:%s*" % prefix)
+    if org_unit:
+        query.append("orgUnitPath=%s" % quote(org_unit))
+    if not params and not query:
+        return None
+    if query:
+        params['query'] = ' '.join(query)
+    return params
+
+def list_users(admin_client, domain, queries, fields, max_results=500):
+    """
+    Yields every user matching at least one of the users.list parameter sets in queries once.
+    A None in queries lists the whole domain. The caller still matches each user client-side.
+    """
+    if None in queries:
+        queries = [{}]
+    seen = set()
+    for query in unique(queries):
+        params = dict(domain=domain, maxResults=max_results, fields=fields)
+        params.update(query)
+        for user in exhaust(admin_client.users().list, params, 'users'):
+            if user[u'primaryEmail'] not in seen:
+                seen.add(user[u'primaryEmail'])
+                yield user
+
+def unique(queries):
+    result = []
+    for query in queries:
+        if query not in result:
+            result.append(query)
+    return result
@@ -0,0 +1,426 @@
+import os
+import re
+import json
+import time
+import random
+import urllib
+import urlparse
+import datetime
+import itertools
+import threading
+
+import httplib2
+import atom.core
+import atom.data
+import gdata.data
+import gdata.client
+from oauth2client.client import AccessTokenCredentials
+from gdata.contacts.data import ContactsFeed, ContactEntry, GroupsFeed, GroupEntry, SystemGroup, GroupMembershipInfo
+from gdata.calendar_resource.data import CalendarResourceEntry, CalendarResourceFeed
+
+import shared.google_apis as google_apis
+from shared.google_apis import DISCOVERY_DIR
+
+"""
+In-process stand-in for the Google APIs used by the copiers: the Contacts groups and
+contacts feeds (queries, batch feeds, 412 ETag conflicts), Admin SDK Directory
+users.list/users.get, the Calendar Resource feed and the bundled discovery documents.
+It replaces the connection pool and the credentials of shared.google_apis, so the
+client builders and everything above them run as against Google:
+
+    google = FakeGoogle(domain='example.com')
+    google.users.extend(synthetic_users(1000, 'example.com'))
+    google.install()
+
+Latency, quotas and errors can be injected, see FakeGoogle.
+"""
+CONTACTS_BASE = 'http://www.google.com/m8/feeds'
+CONTACTS_FULL = 'https://www.google.com/m8/feeds'
+GDATA_VERSION = gdata.client.get_xml_version('3')
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def copy_entry(entry, cls):
+    return atom.core.parse(entry.to_string(GDATA_VERSION), cls, version=GDATA_VERSION)
+
+def synthetic_users(count, domain, start=0, org_unit=u'/'):
+    """
+    Directory users as returned by users.list, with the fields the users copier reads.
+    Every 10th user has no phone number, every 3rd an alias, every 4th an IM account.
+    """
+    users = []
+    for n in range(start, start + count):
+        email = u'user%d@%s' % (n, domain)
+        user = {u'primaryEmail': email,
+            u'name': {u'givenName': u'Given%d' % n, u'familyName': u'Family%d' % (n % 97), u'fullName': u'Given%d Family%d' % (n, n % 97)},
+            u'emails': [{u'address': email, u'primary': True}, {u'address': u'u%d@home.example' % n, u'type': u'home'}],
+            u'phones': [{u'value': u'+358 40 %07d' % n, u'type': u'work', u'primary': True}, {u'value': u'+358 50 %07d' % n, u'type': u'mobile'}]
+                if n % 10 else [],
+            u'externalIds': [{u'type': u'organization', u'value': u'%d' % n}],
+            u'organizations': [{u'name': u'Org', u'title': u'Title %d' % (n % 50), u'department': u'Dept %d' % (n % 20), u'primary': True}],
+            u'addresses': [{u'type': u'work', u'formatted': u'Street %d\n00100 Helsinki' % (n % 300), u'primary': True}],
+            u'orgUnitPath': org_unit}
+        if n % 3 == 0:
+            user[u'aliases'] = [u'alias%d@%s' % (n, domain)]
+        if n % 4 == 0:
+            user[u'ims'] = [{u'type': u'work', u'protocol': u'gtalk', u'im': u'user%d.im@%s' % (n, domain), u'primary': True}]
+        users.append(user)
+    return users
+
+def synthetic_calendar_resources(count, domain, start=0):
+    """Calendar Resources as dicts of their feed properties."""
+    return [{'resourceId': 'r%d' % n,
+        'resourceCommonName': 'Room %d' % n,
+        'resourceDescription': 'Room %d, floor %d' % (n, n % 5),
+        'resourceType': 'Meeting room',
+        'resourceEmail': '%s_r%d@resource.calendar.google.com' % (domain, n)}
+        for n in range(start, start + count)]
+
+class Mailbox(object):
+    """Contacts and groups of one user."""
+    def __init__(self, user):
+        self.user = user
+        self.groups = {}
+        self.contacts = {}
+        self.deleted = {}
+
+class FakeGoogle(object):
+    """
+    State and request handling of the fake APIs. Besides the data (mailboxes, users,
+    calendar_resources) tests and benchmarks can set:
+    latency          seconds every request takes
+    quota            requests per second per user, more are answered with 429 (0 for no limit)
+    error_rate       share of requests failing with 503
+    conflict_ids     contact keys whose next batch update or delete fails with 412
+    throttle_ids     contact keys (or full names of inserted contacts) whose next batch operation fails with 503
+    fail_next()      fails the next whole requests with a given status
+    Every request is recorded in `requests` as (user, method, path), the bytes of
+    request and response bodies are counted in bytes_received and bytes_sent.
+    """
+    def __init__(self, domain='example.com', latency=0.0, quota=0, error_rate=0.0, seed=None):
+        self.domain = domain
+        self.latency = latency
+        self.quota = quota
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.mailboxes = {}
+        self.users = []
+        self.calendar_resources = []
+        self.requests = []
+        self.conflict_ids = set()
+        self.throttle_ids = set()
+        self.failures = []
+        self.windows = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def add_personal_contacts(self, user, count, group_name='Friends'):
+        """Contacts that the user manages, in a group of their own."""
+        box = self.mailbox(user)
+        with self.lock:
+            group = GroupEntry(title=atom.data.Title(text=group_name))
+            group_key = self.stamp(group, 'groups', user)
+            box.groups[group_key] = group
+            for n in range(count):
+                contact = ContactEntry(name=gdata.data.Name(full_name=gdata.data.FullName(text=u'Friend %d' % n)))
+                contact.email.append(gdata.data.Email(address=u'friend%d@personal.example' % n, rel=gdata.data.HOME_REL))
+                contact.group_membership_info.append(GroupMembershipInfo(href=group.id.text))
+                box.contacts[self.stamp(contact, 'contacts', user)] = contact
+
+    def fail_next(self, status, count=1):
+        with self.lock:
+            self.failures.extend([status] * count)
+
+    def mailbox(self, user):
+        with self.lock:
+            if user not in self.mailboxes:
+                box = self.mailboxes[user] = Mailbox(user)
+                group = GroupEntry(title=atom.data.Title(text='System Group: My Contacts'), system_group=SystemGroup(id='Contacts'))
+                box.groups['6'] = group
+                self.stamp(group, 'groups', user, '6')
+            return self.mailboxes[user]
+
+    def stamp(self, entry, kind, user, key=None):
+        """Gives an entry its server-side ID, links, updated time and a new ETag."""
+        key = key or '%x' % next(self.ids)
+        entry.id = atom.data.Id(text='%s/%s/%s/base/%s' % (CONTACTS_BASE, kind, urllib.quote(user), key))
+        entry.link = [atom.data.Link(rel='edit', href='%s/%s/%s/full/%s' % (CONTACTS_FULL, kind, urllib.quote(user), key)),
+                      atom.data.Link(rel='self', href='%s/%s/%s/full/%s' % (CONTACTS_FULL, kind, urllib.quote(user), key))]
+        entry.updated = atom.data.Updated(text=now())
+        entry.etag = '"%x"' % next(self.ids)
+        entry.batch_id = None
+        entry.batch_operation = None
+        entry.batch_status = None
+        return key
+
+    def over_quota(self, user):
+        if not self.quota:
+            return False
+        second = int(time.time())
+        with self.lock:
+            window = self.windows.get(user)
+            if window is None or window[0] != second:
+                window = self.windows[user] = [second, 0]
+            window[1] += 1
+            return window[1] > self.quota
+
+    def injected_failure(self, user):
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+        if self.over_quota(user):
+            return 429
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 503
+        return None
+
+    def handle(self, user, method, uri, body):
+        """(status, content) of a request made on behalf of user."""
+        status, content = self.respond(user, method, uri, body)
+        with self.lock:
+            self.bytes_received += len(body or '')
+            self.bytes_sent += len(content)
+        return status, content
+
+    def respond(self, user, method, uri, body):
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urlparse.urlparse(uri)
+        path, query = parsed.path, dict(urlparse.parse_qsl(parsed.query))
+        if path.startswith('/discovery/v1/apis/'):
+            return self.handle_discovery(path)
+        with self.lock:
+            self.requests.append((user, method, path))
+        status = self.injected_failure(user)
+        if status:
+            return status, 'Rate Limit Exceeded' if status == 429 else 'Injected failure'
+        if path.startswith('/m8/feeds/'):
+            return self.handle_contacts(user, method, path, query, body)
+        if path.startswith('/admin/directory/v1/users'):
+            return self.handle_directory(method, path, query)
+        if path.startswith('/a/feeds/calendar/resource/'):
+            return self.handle_calendar_resources(method)
+        return 404, 'Not found'
+
+    #
+    # Discovery documents, those bundled in shared/discovery
+    #
+
+    def handle_discovery(self, path):
+        # /discovery/v1/apis/<api>/<version>/rest
+        parts = path.split('/')
+        file_name = os.path.join(DISCOVERY_DIR, '%s.%s.json' % (parts[4], parts[5]))
+        if not os.path.exists(file_name):
+            return 404, 'Not found'
+        with open(file_name) as f:
+            return 200, f.read()
+
+    #
+    # Contacts API
+    #
+
+    def handle_contacts(self, user, method, path, query, body):
+        box = self.mailbox(user)
+        parts = path.split('/')
+        # /m8/feeds/<kind>/<user>/full[/<key>|/batch]
+        kind = parts[3]
+        key = parts[6] if len(parts) > 6 else None
+        with self.lock:
+            if kind == 'groups':
+                return self.groups(box, method, key, body)
+            if key == 'batch':
+                return self.batch(box, body)
+            if method == 'GET' and key:
+                if key not in box.contacts:
+                    return 404, 'Not found'
+                return 200, box.contacts[key].to_string(GDATA_VERSION)
+            if method == 'GET':
+                return self.contacts_feed(box, query)
+        return 400, 'Unsupported'
+
+    def groups(self, box, method, key, body):
+        if method == 'GET':
+            feed = GroupsFeed()
+            feed.entry = box.groups.values()
+            return 200, feed.to_string(GDATA_VERSION)
+        if method == 'POST':
+            group = atom.core.parse(body, GroupEntry, version=GDATA_VERSION)
+            key = self.stamp(group, 'groups', box.user)
+            box.groups[key] = group
+            return 201, group.to_string(GDATA_VERSION)
+        if method == 'PUT':
+            group = atom.core.parse(body, GroupEntry, version=GDATA_VERSION)
+            self.stamp(group, 'groups', box.user, key)
+            box.groups[key] = group
+            return 200, group.to_string(GDATA_VERSION)
+        if method == 'DELETE':
+            box.groups.pop(key, None)
+            return 200, ''
+        return 400, 'Unsupported'
+
+    def contacts_feed(self, box, query):
+        entries = sorted(box.contacts.values(), key=lambda contact: contact.id.text)
+        if query.get('showdeleted'):
+            entries += box.deleted.values()
+        if query.get('group'):
+            entries = [contact for contact in entries
+                if any(membership.href == query['group'] for membership in contact.group_membership_info)]
+        if query.get('updated-min'):
+            entries = [contact for contact in entries if contact.updated.text >= query['updated-min']]
+        start = int(query.get('start-index', 1))
+        size = int(query.get('max-results', 25))
+        feed = ContactsFeed()
+        feed.updated = atom.data.Updated(text=now())
+        feed.entry = entries[start - 1:start - 1 + size]
+        if start - 1 + size < len(entries):
+            next_query = dict(query)
+            next_query['start-index'] = str(start + size)
+            feed.link.append(atom.data.Link(rel='next',
+                href='%s/contacts/%s/full?%s' % (CONTACTS_FULL, urllib.quote(box.user), urllib.urlencode(next_query))))
+        return 200, feed.to_string(GDATA_VERSION)
+
+    def batch(self, box, body):
+        request = atom.core.parse(body, ContactsFeed, version=GDATA_VERSION)
+        response = ContactsFeed()
+        for entry in request.entry:
+            operation = entry.batch_operation.type
+            batch_id = entry.batch_id.text
+            key = entry.id and entry.id.text.rsplit('/', 1)[-1]
+            name = entry.name and entry.name.full_name and entry.name.full_name.text
+            if key in self.throttle_ids or (operation == 'insert' and name in self.throttle_ids):
+                self.throttle_ids.discard(key)
+                self.throttle_ids.discard(name)
+                result, code = ContactEntry(), 503
+            elif operation == 'insert':
+                key = self.stamp(entry, 'contacts', box.user)
+                box.contacts[key] = entry
+                result, code = copy_entry(entry, ContactEntry), 201
+            elif key not in box.contacts:
+                result, code = ContactEntry(), 404
+            elif operation == 'query':
+                result, code = copy_entry(box.contacts[key], ContactEntry), 200
+            elif entry.etag != box.contacts[key].etag or key in self.conflict_ids:
+                self.conflict_ids.discard(key)
+                result, code = ContactEntry(), 412
+            elif operation == 'update':
+                self.stamp(entry, 'contacts', box.user, key)
+                box.contacts[key] = entry
+                result, code = copy_entry(entry, ContactEntry), 200
+            else:
+                gone = box.contacts.pop(key)
+                gone.deleted = gdata.data.Deleted()
+                gone.updated = atom.data.Updated(text=now())
+                box.deleted[key] = gone
+                result, code = ContactEntry(), 200
+            result.batch_id = gdata.data.BatchId(text=batch_id)
+            result.batch_operation = gdata.data.BatchOperation(type=operation)
+            result.batch_status = gdata.data.BatchStatus(code=str(code), reason='Fake')
+            response.entry.append(result)
+        return 200, response.to_string(GDATA_VERSION)
+
+    #
+    # Admin SDK Directory API
+    #
+
+    def handle_directory(self, method, path, query):
+        if method != 'GET':
+            return 400, json.dumps({'error': {'code': 400, 'message': 'Unsupported'}})
+        user_key = urllib.unquote(path[len('/admin/directory/v1/users'):].strip('/'))
+        if user_key:
+            for user in self.users:
+                if user[u'primaryEmail'] == user_key:
+                    return 200, json.dumps(user)
+            return 404, json.dumps({'error': {'code': 404, 'message': 'Resource Not Found: userKey'}})
+        users = [user for user in self.users if matches_user_query(user, query)]
+        start = int(query.get('pageToken') or 0)
+        size = int(query.get('maxResults') or 100)
+        page = {'kind': 'admin#directory#users', 'users': users[start:start + size]}
+        if start + size < len(users):
+            page['nextPageToken'] = str(start + size)
+        return 200, json.dumps(page)
+
+    #
+    # Calendar Resource API
+    #
+
+    def handle_calendar_resources(self, method):
+        if method != 'GET':
+            return 400, 'Unsupported'
+        feed = CalendarResourceFeed()
+        for resource in self.calendar_resources:
+            entry = CalendarResourceEntry()
+            for name, value in sorted(resource.items()):
+                entry._SetProperty(name, value)
+            feed.entry.append(entry)
+        return 200, feed.to_string()
+
+    #
+    # Transport
+    #
+
+    def credentials(self, user):
+        """Credentials of user, whose access token names the user."""
+        return AccessTokenCredentials(TOKEN_PREFIX + (user or ''), 'fake-google')
+
+    def install(self):
+        """
+        Makes shared.google_apis send every request to this fake, through a FakeConnectionPool
+        and with credentials from credentials(). API clients built before are dropped.
+        """
+        pool = FakeConnectionPool(self)
+        google_apis.connection_pool = lambda size=10: pool
+        google_apis.get_service_account_credentials = lambda scopes=[], user_email='', **kwargs: self.credentials(user_email)
+        google_apis.ensureOAuthCredentials = lambda **kwargs: self.credentials(None)
+        with google_apis._process_cache_lock:
+            google_apis._process_cache.clear()
+
+# field, operator and value, quoted (with \' and \\ escaped) or not
+USER_QUERY = re.compile(r"(\w+)(:|=)('(?:[^'\\]|\\.)*'|[^ ]*)")
+ESCAPED = re.compile(r"\\(.)")
+
+def query_value(value):
+    if value.startswith("'"):
+        return ESCAPED.sub(r'\1', value[1:-1])
+    return value
+
+def matches_user_query(user, query):
+    """Whether a user matches the domain and the (email and orgUnitPath) query terms of users.list."""
+    email = user[u'primaryEmail']
+    if query.get('domain') and not email.endswith('@' + query['domain']):
+        return False
+    for field, operator, value in USER_QUERY.findall(query.get('query', '')):
+        value = query_value(value)
+        if field == 'email':
+            if value.endswith('*') and not email.startswith(value[:-1]):
+                return False
+            if not value.endswith('*') and email != value:
+                return False
+        elif field == 'orgUnitPath':
+            # Like the directory, an org unit includes its sub-org-units
+            path = user.get(u'orgUnitPath', u'/')
+            if not (path == value or path.startswith(value.rstrip('/') + '/')):
+                return False
+    return True
+
+TOKEN_PREFIX = 'fake-google:'
+
+def token_user(headers):
+    """The user named by the access token in the Authorization header, see FakeGoogle.credentials()."""
+    headers = dict((name.lower(), value) for name, value in (headers or {}).items())
+    token = headers.get('authorization', '').split(' ', 1)[-1]
+    return token[len(TOKEN_PREFIX):] or None if token.startswith(TOKEN_PREFIX) else None
+
+class FakeConnectionPool(object):
+    """shared.transport.ConnectionPool look-alike sending every request to a FakeGoogle."""
+    def __init__(self, google):
+        self.google = google
+    def request(self, uri, method='GET', body=None, headers=None, follow_redirects=True, **kwargs):
+        status, content = self.google.handle(token_user(headers), method, uri, body)
+        response = httplib2.Response({'status': status,
+            'content-type': 'application/json' if content.startswith('{') else 'application/atom+xml'})
+        return response, content
+    def stats(self):
+        return {'opened': 0, 'reused': 0}
@@ -1,19 +1,42 @@
 import httplib2
 import sys
+import socket
+import os
+import json
+import time
+import base64
+import datetime
+import threading
+import Queue
+from xml.sax.saxutils import quoteattr
 
-from apiclient.discovery import build
-from oauth2client.client import SignedJwtAssertionCredentials
+from apiclient.discovery import build_from_document, DISCOVERY_URI
+from oauth2client import crypt
+from oauth2client.client import SignedJwtAssertionCredentials, EXPIRY_FORMAT
+from oauth2client.client import Storage as CredentialsStore
+from kids.cache import cache
 
 import logging
 import gdata.client
 import atom.http_core
-from gdata.contacts.client import ContactsClient
+from gdata.contacts.client import ContactsClient, ContactsQuery
+from gdata.contacts.data import ContactsFeed
 from gdata.calendar_resource.client import CalendarResourceClient
 from gdata.gauth import OAuth2TokenFromCredentials
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 
 from shared.files import fileloc
+from shared.transport import connection_pool, PooledHttp, PooledHttpClient
+from shared.pool import current_capture, adopt_capture
+from shared.throttle import AdaptiveController, is_retryable, RateLimiter, parse_rate_limits, RETRY_STATUSES, was_not_sent
+from shared.metrics import run_metrics, current_target, adopt_target, OUTCOMES
+
+"""
+Discovery documents bundled as a fallback
+"""
+DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery')
+DISCOVERY_MAX_AGE = 86400
 
 """
 GDATA
@@ -43,41 +66,191 @@ def ensureOAuthCredentials(secrets_file='client_secrets.json',
         storage.put(credentials)
     return credentials
 
-def get_service_account_credentials(scopes=[], user_email='', pkcs12_file_path='', service_account_email=''):
+@cache
+def read_private_key(pkcs12_file_path):
+    """Contents of the service account key file, read once per process."""
     with file(fileloc(pkcs12_file_path), 'rb') as f:
-        key = f.read()
-    return SignedJwtAssertionCredentials(service_account_email,
-        key,
+        return f.read()
+
+@cache
+def get_signer(private_key, private_key_password):
+    """Parsed signing key, once per process instead of on every token request."""
+    return crypt.Signer.from_string(private_key, private_key_password)
+
+class ServiceAccountCredentials(SignedJwtAssertionCredentials):
+    """SignedJwtAssertionCredentials that share one parsed signing key."""
+    def _generate_assertion(self):
+        now = int(time.time())
+        payload = {
+            'aud': self.token_uri,
+            'scope': self.scope,
+            'iat': now,
+            'exp': now + self.MAX_TOKEN_LIFETIME_SECS,
+            'iss': self.service_account_name,}
+        payload.update(self.kwargs)
+        return crypt.make_signed_jwt(get_signer(base64.b64decode(self.private_key), self.private_key_password), payload)
+    def _refresh(self, http_request):
+        with run_metrics().phase('token'):
+            super(ServiceAccountCredentials, self)._refresh(http_request)
+
+class TokenCache(CredentialsStore):
+    """
+    Access tokens of service account credentials, kept in one JSON file across runs:
+    {key: {"access_token": ..., "token_expiry": ...}}
+    """
+    lock = threading.Lock() # guards the file, token requests themselves run in parallel
+    # tokens expiring sooner than this are not reused
+    margin = datetime.timedelta(minutes=5)
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+    def acquire_lock(self):
+        pass
+    def release_lock(self):
+        pass
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+    def is_fresh(self, token):
+        expiry = datetime.datetime.strptime(token['token_expiry'], EXPIRY_FORMAT)
+        return expiry - self.margin > datetime.datetime.utcnow()
+    def restore(self, credentials):
+        """Sets the cached access token on credentials, if there still is one."""
+        with self.lock:
+            token = self.read().get(self.key)
+        if token and self.is_fresh(token):
+            credentials.access_token = token['access_token']
+            credentials.token_expiry = datetime.datetime.strptime(token['token_expiry'], EXPIRY_FORMAT)
+    def locked_get(self):
+        return None # tokens are restored when the credentials are created
+    def locked_put(self, credentials):
+        if not credentials.token_expiry:
+            return
+        with self.lock:
+            tokens = dict((key, token) for key, token in self.read().iteritems() if self.is_fresh(token))
+            tokens[self.key] = {'access_token': credentials.access_token,
+                'token_expiry': credentials.token_expiry.strftime(EXPIRY_FORMAT)}
+            tmp_path = self.path + '.tmp'
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as f:
+                json.dump(tokens, f)
+            os.rename(tmp_path, self.path)
+    def locked_delete(self):
+        pass
+
+_process_cache = {}
+_process_cache_lock = threading.Lock()
+
+def process_cached(key, factory):
+    """
+    Object by key, created once per process: credentials so that their access
+    token is reused, API clients so that their discovery document is parsed once.
+    factory() runs outside the lock, as it may be slow and create other objects
+    this way. Of objects created concurrently for the same key the first is kept.
+    """
+    with _process_cache_lock:
+        if key in _process_cache:
+            return _process_cache[key]
+    value = factory()
+    with _process_cache_lock:
+        return _process_cache.setdefault(key, value)
+
+def get_service_account_credentials(scopes=[], user_email='', pkcs12_file_path='', service_account_email='', token_cache_file=''):
+    credentials = ServiceAccountCredentials(service_account_email,
+        read_private_key(pkcs12_file_path),
         scope=scopes,
         sub=user_email)
+    if token_cache_file:
+        credentials.set_store(TokenCache(fileloc(token_cache_file),
+            ' '.join([service_account_email, user_email] + sorted(scopes))))
+        credentials.store.restore(credentials)
+    return credentials
 
 def get_credentials(scopes, email, options, storage_file='a_credentials_file'):
     if email:
-        credentials = get_service_account_credentials(scopes=scopes,
+        credentials = process_cached(('service_account', email, tuple(sorted(scopes))),
+            lambda: get_service_account_credentials(scopes=scopes,
                 user_email=email,
                 pkcs12_file_path=options.service_account_pkcs12_file_path,
-                service_account_email=options.service_account_email,)
+                service_account_email=options.service_account_email,
+                token_cache_file=getattr(options, 'token_cache_file', ''),))
     else:
-        credentials = ensureOAuthCredentials(scopes=scopes, storage_file=fileloc(storage_file))
+        credentials = process_cached(('oauth', storage_file, tuple(sorted(scopes))),
+            lambda: ensureOAuthCredentials(scopes=scopes, storage_file=fileloc(storage_file)))
     return credentials
 
-def get_gdata_api(name, credentials, domain='', extra_kw={}):
-    client = GDATA_SERVICES[name](domain=domain, **extra_kw)
+def get_gdata_api(name, credentials, domain='', extra_kw={}, pool=None, limit=None, observe=None):
+    client = GDATA_SERVICES[name](domain=domain, http_client=PooledHttpClient(pool or connection_pool(), limit, observe), **extra_kw)
     token = OAuth2TokenFromCredentials(credentials)
     return token.authorize(client)
 
-def get_discovery_api(name, version, credentials):
-    http = httplib2.Http()
+def get_discovery_api(name, version, credentials, pool=None, cache_dir='', max_age=DISCOVERY_MAX_AGE, limit=None, observe=None):
+    pool = pool or connection_pool()
+    http = PooledHttp(pool, limit, observe)
     http = credentials.authorize(http)
-    return build(serviceName=name, version=version, http=http)
+    return build_from_document(get_discovery_document(name, version, pool, cache_dir, max_age), http=http)
+
+def get_discovery_document(name, version, pool, cache_dir='', max_age=DISCOVERY_MAX_AGE):
+    """
+    Discovery document of an API, from cache_dir while it is younger than max_age seconds.
+    Otherwise it is fetched and cached. If that fails, a stale cached copy or the
+    (minimal) copy bundled in shared/discovery is used instead.
+    """
+    file_name = '%s.%s.json' % (name, version)
+    path = os.path.join(fileloc(cache_dir), file_name) if cache_dir else None
+    if path and os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+        with open(path) as f:
+            return f.read()
+
+    url = DISCOVERY_URI.replace('{api}', name).replace('{apiVersion}', version)
+    try:
+        response, content = pool.request(url)
+        if response.status != 200:
+            raise IOError('HTTP %d' % response.status)
+        json.loads(content)
+    except (httplib2.HttpLib2Error, IOError, ValueError) as e:
+        for fallback in [path, os.path.join(DISCOVERY_DIR, file_name)]:
+            if fallback and os.path.exists(fallback):
+                logging.warn('Could not fetch discovery document %s (%s), using %s', url, e, fallback)
+                with open(fallback) as f:
+                    return f.read()
+        raise
+
+    if path:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(path + '.tmp', path)
+    return content
+
+def get_pool(options):
+    return connection_pool(int(options.http_pool_size))
+
+@cache
+def rate_limiter(rate_limits='', rate_limit_file=''):
+    """The process-wide limiter."""
+    return RateLimiter(parse_rate_limits(rate_limits), fileloc(rate_limit_file) if rate_limit_file else '')
+
+def get_limiter(options):
+    return rate_limiter(options.rate_limits, options.rate_limit_file)
 
 def calendar(email=None, options=None):
-    return get_discovery_api(name='calendar',
+    return process_cached(('discovery', 'calendar', 'v3', email),
+        lambda: get_discovery_api(name='calendar',
             version='v3',
             credentials=get_credentials(scopes=[
                 'https://www.googleapis.com/auth/calendar',
                 'https://apps-apis.google.com/a/feeds/calendar/resource/',],
-                email=email, options=options))
+                email=email, options=options),
+            pool=get_pool(options),
+            cache_dir=options.discovery_cache_dir,
+            max_age=int(options.discovery_cache_max_age),
+            limit=get_limiter(options).bind('calendar', email),
+            observe=run_metrics().observer('calendar')))
 
 def calendar_resource(email=None, options=None):
     return get_gdata_api(name='calendar_resource',
@@ -85,7 +258,10 @@ def calendar_resource(email=None, options=None):
             credentials=get_credentials(scopes=['https://apps-apis.google.com/a/feeds/calendar/resource/',],
                 email=email,
                 options=options,
-                storage_file='gdata_credentials_file'))
+                storage_file='gdata_credentials_file'),
+            pool=get_pool(options),
+            limit=get_limiter(options).bind('calendar_resource', email),
+            observe=run_metrics().observer('calendar_resource'))
 
 def contacts(email=None, options=None):
     return get_gdata_api(name='contacts',
@@ -93,83 +269,376 @@ def contacts(email=None, options=None):
             credentials=get_credentials(scopes=['https://www.google.com/m8/feeds',],
                 email=email,
                 options=options,
-                storage_file='gdata_credentials_file'))
+                storage_file='gdata_credentials_file'),
+            pool=get_pool(options),
+            limit=get_limiter(options).bind('contacts', email),
+            observe=run_metrics().observer('contacts'))
 
 def admin(email=None, options=None):
-    return get_discovery_api(name='admin',
+    return process_cached(('discovery', 'admin', 'directory_v1', email),
+        lambda: get_discovery_api(name='admin',
             version='directory_v1',
             credentials=get_credentials(scopes=[
                 'https://www.googleapis.com/auth/admin.directory.group',
                 'https://www.googleapis.com/auth/admin.directory.user',],
-                email=email, options=options))
+                email=email, options=options),
+            pool=get_pool(options),
+            cache_dir=options.discovery_cache_dir,
+            max_age=int(options.discovery_cache_max_age),
+            limit=get_limiter(options).bind('admin', email),
+            observe=run_metrics().observer('admin')))
 
 def submit_batch(contacts_client, feed, force=False, batch_max=100):
     if not force and len(feed.entry) < int(batch_max):
         return # Wait for more requests
-    submit_feed(contacts_client, feed)
-
-def submit_feed(contacts_client, feed):
-    result_feed = patched_batch(contacts_client, feed)
-    for result in result_feed.entry:
-        try: status_code = int(result.batch_status.code)
-        except ValueError: status_code = -1
-        if status_code < 200 or status_code >= 400:
-            logging.warn("Error %d (%s) while %s'ing batch ID %s = %s (%s)",
-                status_code,
-                result.batch_status.reason,
-                result.batch_operation.type,
-                result.batch_id.text,
-                result.id and result.id.text or result.get_id(),
-                result.name and result.name.full_name and result.name.full_name or "name unknown")
+    submit_feed(contacts_client, [entry_to_string(contacts_client, entry) for entry in feed.entry], feed.entry)
+
+def submit_feed(contacts_client, fragments, entries, desired_class=ContactsFeed, conflict_rounds=3, controller=None, outcomes=None):
+    """
+    Posts a batch feed of serialized entries and returns the number of operations that failed.
+    Operations throttled or failed by a server error are repeated after a backoff, at most
+    controller.max_retries times. Operations failing due to an ETag mismatch are forced with
+    the current ETags of their contacts, for at most conflict_rounds rounds. Only the failed
+    operations are repeated, under their original batch IDs. Outcomes are counted in run_metrics(),
+    outcomes optionally names the outcome of each operation succeeding instead of its type.
+    """
+    metrics = run_metrics()
+    controller = controller or AdaptiveController(len(fragments))
+    fragments = list(fragments)
+    pending = range(len(fragments))
+    failed = 0
+    conflict_round = retry = 0
+    since = server_time_before()
+    while pending:
+        conflicts = []
+        retries = []
+        inserts = [index for index in pending if entries[index].id is None]
+        try:
+            result_feed = post_batch(contacts_client, FEED_XML % ''.join(fragments[index] for index in pending),
+                desired_class, controller, idempotent=not inserts)
+        except gdata.client.RequestError as e:
+            # The server may have applied the feed: inserts are only repeated if their contact does not exist
+            if not inserts or e.status not in RETRY_STATUSES or retry == controller.max_retries:
+                raise
+            controller.backoff(retry, "Batch request with %d insert(s) failed with %s (%s)" % (len(inserts), e.status, e.reason))
+            retry += 1
+            inserted = find_inserted(contacts_client, entries, inserts, since)
+            metrics.outcome('inserted', len(inserted))
+            pending = [index for index in pending if index not in inserted]
+            continue
+        for result in result_feed.entry:
+            try: status_code = int(result.batch_status.code)
+            except ValueError: status_code = -1
             if status_code == 412:
-                logging.warn("Forcing %s due Etags mismatch"%result.batch_operation.type)
-                entry = feed.entry[int(result.batch_id.text)]
-                getattr(contacts_client, result.batch_operation.type)(entry, force=True)
+                conflicts.append(int(result.batch_id.text))
+            elif is_retryable(status_code, result.batch_status.reason):
+                retries.append(int(result.batch_id.text))
+            elif 200 <= status_code < 400:
+                index = int(result.batch_id.text)
+                metrics.outcome(outcomes and outcomes[index] or
+                    OUTCOMES.get(result.batch_operation.type, result.batch_operation.type))
+            else:
+                logging.warn("Error %d (%s) while %s'ing batch ID %s = %s (%s)",
+                    status_code,
+                    result.batch_status.reason,
+                    result.batch_operation.type,
+                    result.batch_id.text,
+                    result.id and result.id.text or result.get_id(),
+                    result.name and result.name.full_name and result.name.full_name or "name unknown")
+                failed += 1
+        pending = []
+        metrics.outcome('conflicted', len(conflicts))
+        if retries:
+            if retry == controller.max_retries:
+                logging.warn("%d operation(s) still throttled after %d retries", len(retries), retry)
+                failed += len(retries)
+            else:
+                controller.backoff(retry, "%d operation(s) throttled" % len(retries))
+                retry += 1
+                pending.extend(retries)
+        if conflicts:
+            if conflict_round == int(conflict_rounds):
+                logging.warn("%d ETag conflict(s) left unresolved after %d round(s): %s",
+                    len(conflicts), conflict_round, ', '.join(entries[index].id.text for index in conflicts))
+                failed += len(conflicts)
+            else:
+                logging.info("Forcing %d operation(s) due Etags mismatch", len(conflicts))
+                conflict_round += 1
+                forced, vanished = refresh_etags(contacts_client, fragments, entries, conflicts)
+                failed += vanished
+                pending.extend(forced)
+        pending.sort()
+    metrics.outcome('failed', failed)
+    return failed
+
+def refresh_etags(contacts_client, fragments, entries, indices):
+    """
+    Re-serializes the conflicted entries at indices with the current ETags of their
+    contacts, fetched in bulk. Returns (indices to repeat, number of updated contacts
+    that no longer exist).
+    """
+    current = dict((contact.id.text, contact)
+        for contact in query_contacts(contacts_client, [entries[index].id.text for index in indices]))
+    forced = []
+    vanished = 0
+    for index in indices:
+        entry = entries[index]
+        contact = current.get(entry.id.text)
+        if contact is None:
+            vanished += entry.batch_operation.type != 'delete'
+            continue
+        entry.etag = contact.etag
+        fragments[index] = entry_to_string(contacts_client, entry)
+        forced.append(index)
+    return forced, vanished
+
+def post_batch(contacts_client, feed_string, desired_class, controller, idempotent=True):
+    """
+    Posts a batch feed paced by controller, repeating requests that were throttled as a whole.
+    Requests that failed with a server error may have been applied nonetheless, so they are
+    only repeated if the feed is idempotent, i.e. has no inserts. Otherwise the error is raised.
+    """
+    attempt = 0
+    while True:
+        controller.wait()
+        started = time.time()
+        try:
+            result_feed = patched_batch(contacts_client, feed_string, desired_class)
+        except gdata.client.RequestError as e:
+            if attempt == controller.max_retries or not is_retryable(e.status, '%s %s' % (e.reason, e.body)) \
+                    or (e.status >= 500 and not idempotent):
+                raise
+            controller.backoff(attempt, "Batch request failed with %s (%s)" % (e.status, e.reason))
+            attempt += 1
+            continue
+        except (httplib2.HttpLib2Error, socket.error) as e:
+            if attempt == controller.max_retries or not was_not_sent(e):
+                raise
+            controller.backoff(attempt, "Batch request could not be sent (%s)" % e)
+            attempt += 1
+            continue
+        controller.succeeded(time.time() - started)
+        return result_feed
+
+def server_time_before(margin=datetime.timedelta(minutes=5)):
+    """A time before now on the server's clock, as far as the clocks agree within margin."""
+    return (datetime.datetime.utcnow() - margin).strftime('%Y-%m-%dT%H:%M:%S')
+
+def insert_key(contact):
+    """What tells an inserted contact apart: its extended properties (e.g. the source ID) and emails."""
+    return (tuple(sorted((prop.name, prop.value) for prop in contact.extended_property)),
+        tuple(sorted((email.address or '').lower() for email in contact.email)))
+
+def find_inserted(contacts_client, entries, indices, since):
+    """The indices of the insert entries whose contact exists, looking at the contacts updated since."""
+    wanted = dict((insert_key(entries[index]), index) for index in indices)
+    query = ContactsQuery()
+    query.updated_min = since
+    feed = contacts_client.get_contacts(q=query)
+    found = set()
+    while feed is not None:
+        for contact in feed.entry:
+            index = wanted.get(insert_key(contact))
+            if index is not None:
+                found.add(index)
+        feed = contacts_client.get_next(feed) if feed.find_next_link() else None
+    return found
+
+"""
+Batch feeds are built by concatenating separately serialized entries, so that
+entries shared by all target users (contact templates) are serialized only once.
+Every entry carries its own namespace declarations.
+"""
+FEED_XML = '<feed xmlns="http://www.w3.org/2005/Atom">%s</feed>'
+GROUP_MEMBERSHIP_XML = '<gContact:groupMembershipInfo xmlns:gContact="http://schemas.google.com/contact/2008" deleted="false" href=%s />'
+BATCH_XML = ('<batch:id xmlns:batch="http://schemas.google.com/gdata/batch">%s</batch:id>'
+    '<batch:operation xmlns:batch="http://schemas.google.com/gdata/batch" type="%s" />')
 
 # http://stackoverflow.com/questions/23576729/getting-if-match-or-if-none-match-header-or-entry-etag-attribute-required-erro
-def patched_post(client, entry, uri, auth_token=None, converter=None, desired_class=None, **kwargs):
-    if converter is None and desired_class is None:
-        desired_class = entry.__class__
-    http_request = atom.http_core.HttpRequest()
+def entry_to_string(client, entry):
     entry_string = entry.to_string(gdata.client.get_xml_version(client.api_version))
-    entry_string = entry_string.replace('ns1', 'gd') # where the magic happens
+    return entry_string.replace('ns1', 'gd') # where the magic happens
+
+def feed_to_string(client, feed):
+    return FEED_XML % ''.join(entry_to_string(client, entry) for entry in feed.entry)
+
+def splice_entry(entry_string, fragments):
+    """Appends XML fragments as the last children of a serialized entry."""
+    head, tail = entry_string.rsplit('</', 1)
+    return ''.join([head] + fragments + ['</', tail])
+
+def render_template(client, template):
+    """Serialized form of an entry that is never modified, computed once and kept with the entry."""
+    rendered = getattr(template, '_rendered', None)
+    if rendered is None:
+        rendered = template._rendered = entry_to_string(client, template)
+    return rendered
+
+def patched_post(client, entry_string, uri, auth_token=None, converter=None, desired_class=None, **kwargs):
+    http_request = atom.http_core.HttpRequest()
     http_request.add_body_part(entry_string, 'application/atom+xml')
     return client.request(method='POST', uri=uri, auth_token=auth_token,
             http_request=http_request,
             converter=converter,
             desired_class=desired_class, **kwargs)
 
-def patched_batch(client_instance, entry_feed):
-    return patched_post(client_instance, entry_feed, 'https://www.google.com/m8/feeds/contacts/default/full/batch')
+def patched_batch(client_instance, feed_string, desired_class=ContactsFeed):
+    return patched_post(client_instance, feed_string, 'https://www.google.com/m8/feeds/contacts/default/full/batch',
+            desired_class=desired_class)
+
+class Submitter(object):
+    """
+    Posts batch feeds in order on a background thread, so that the next feed is
+    built while the previous one is on the wire. put() blocks while `depth` feeds
+    are waiting. One Submitter serves all batches of a target user, flush() waits
+    for the feeds put so far. An error is raised from the next put() or flush(),
+    later feeds are dropped. If the creating thread captures its log records (see
+    shared.pool), those of the submits are captured apart and added on close().
+    """
+    def __init__(self, depth):
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self.records = [] if current_capture() is not None else None
+        self.thread = threading.Thread(target=self.run, args=(current_target(),))
+        self.thread.daemon = True
+        self.thread.start()
+    def put(self, submit, *args):
+        """Calls submit(*args) on the background thread."""
+        self.raise_error()
+        self.queue.put((submit, args))
+    def run(self, target):
+        adopt_capture(self.records)
+        adopt_target(target)
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None: # after an error, feeds are only drained
+                    submit, args = item
+                    try:
+                        submit(*args)
+                    except Exception:
+                        self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+    def flush(self):
+        """Waits for the feeds put so far."""
+        self.queue.join()
+        self.raise_error()
+    def close(self):
+        """Waits for the feeds put so far and stops the thread, without raising their error."""
+        self.queue.put(None)
+        self.thread.join()
+        capture = current_capture()
+        if self.records and capture is not None:
+            capture.extend(self.records)
 
 class Batch(object):
-    def __init__(self, client, cls, batch_max=100):
+    """
+    Collects batch operations and submits them in batches of at most batch_max,
+    sized by the controller pacing the requests of the client.
+    With hold=True nothing is submitted before close(), e.g. while the feed
+    that the operations were derived from is still being paged through.
+    With a submitter feeds are submitted in the background, see Submitter.
+    progress(operations, failed) is called after every feed submitted.
+    An operation put with an outcome is counted under it once it succeeds, e.g. 'renamed'.
+    """
+    def __init__(self, client, cls, batch_max=100, hold=False, submitter=None, conflict_rounds=3, controller=None, progress=None):
         self.client = client
         self.cls = cls
-        self.feed = cls()
-        self.batch_max = batch_max
-    def reset(self):
-        self.feed = self.cls()
-    def put(self, name, data):
-        getattr(self.feed, name)(entry=data)
-        if self.total()>=self.batch_max:
+        self.batch_max = int(batch_max)
+        self.controller = controller or AdaptiveController(self.batch_max)
+        self.progress = progress
+        self.hold = hold
+        self.conflict_rounds = int(conflict_rounds)
+        self.pending = []
+        self.failed = 0
+        self.submitter = submitter
+    def put(self, name, data, outcome=None):
+        self.add((name, data, None, outcome))
+    def put_template(self, template, group_hrefs):
+        """Inserts a shared template entry as a member of the given groups, without modifying it."""
+        self.add(('add_insert', template, group_hrefs, None))
+    def add(self, operation):
+        self.pending.append(operation)
+        if not self.hold and self.total()>=self.batch_size():
             self.submit()
     def total(self):
-        return len(self.feed.entry)
+        return len(self.pending)
+    def batch_size(self):
+        return min(self.batch_max, self.controller.size)
+    def render(self, operations):
+        feed = self.cls()
+        entries = []
+        fragments = []
+        outcomes = []
+        for name, data, group_hrefs, outcome in operations:
+            batch_id = str(len(entries))
+            if group_hrefs is None:
+                getattr(feed, name)(entry=data, batch_id_string=batch_id)
+                entries.append(feed.entry[-1])
+                fragments.append(entry_to_string(self.client, feed.entry[-1]))
+            else:
+                entries.append(data)
+                fragments.append(splice_entry(render_template(self.client, data),
+                    [GROUP_MEMBERSHIP_XML % quoteattr(href) for href in group_hrefs] +
+                    [BATCH_XML % (batch_id, 'insert')]))
+            outcomes.append(outcome)
+        return fragments, entries, outcomes
     def submit(self):
-        submit_feed(self.client, self.feed)
-        self.reset()
+        while self.pending:
+            size = self.batch_size()
+            operations, self.pending = self.pending[:size], self.pending[size:]
+            fragments, entries, outcomes = self.render(operations)
+            if self.submitter:
+                self.submitter.put(self.submit_failed, fragments, entries, outcomes)
+            else:
+                self.submit_failed(fragments, entries, outcomes)
+    def submit_failed(self, fragments, entries, outcomes=None):
+        self.failed += self.submit_feed(fragments, entries, outcomes)
+    def submit_feed(self, fragments, entries, outcomes=None):
+        run_metrics().batch(len(entries))
+        with run_metrics().phase('submit'):
+            failed = submit_feed(self.client, fragments, entries, self.cls, self.conflict_rounds, self.controller, outcomes)
+        if self.progress:
+            self.progress(len(entries), failed)
+        return failed
     def close(self):
         self.submit()
+        if self.submitter:
+            self.submitter.flush()
+
+def query_contacts(contacts_client, contact_ids, batch_max=100):
+    """Yields the current version of the contacts with the given IDs, fetching batch_max per request."""
+    contact_ids = list(contact_ids)
+    batch_max = int(batch_max)
+    controller = getattr(contacts_client, 'batch_controller', None) or AdaptiveController(batch_max)
+    for start in range(0, len(contact_ids), batch_max):
+        feed = ContactsFeed()
+        for contact_id in contact_ids[start:start + batch_max]:
+            feed.add_query(url_string=contact_id, batch_id_string=str(len(feed.entry)))
+        for result in post_batch(contacts_client, feed_to_string(contacts_client, feed), ContactsFeed, controller).entry:
+            if result.batch_status is not None and result.batch_status.code == '200':
+                result.batch_id = result.batch_operation = result.batch_status = None
+                yield result
+            else:
+                logging.warn("Error %s (%s) while querying %s",
+                    result.batch_status and result.batch_status.code,
+                    result.batch_status and result.batch_status.reason,
+                    contact_ids[start + int(result.batch_id.text)])
 
 def exhaust(query, params, key):
-    results = []
+    """Yields the items under `key` of every result page of a Discovery API list query."""
+    params = dict(params)
     while True:
         result = query(**params).execute()
-        results += result.get(key)
+        for item in result.get(key, []):
+            yield item
         if 'nextPageToken' in result:
             params['pageToken'] = result['nextPageToken']
         else:
             break
-    return results
-
@@ -1,24 +1,115 @@
-from contextlib import closing
+from contextlib import closing, contextmanager
+from itertools import ifilter
 import logging
 
 from shared.options import options
-from shared.google_apis import Batch
+from shared.google_apis import Batch, Submitter, query_contacts, get_pool, get_limiter
+from shared.throttle import AdaptiveController
+from shared.snapshot import record_digest
+from shared.journal import RunJournal
+from shared.schedule import Scheduler, parse_deadline, prioritize
+from shared.shard import run_sharded
+from shared.metrics import run_metrics, save_report
+from shared.files import fileloc
 
 from atom.data import Title
 from gdata.data import ExtendedProperty
-from gdata.contacts.data import GroupEntry
+from gdata.contacts.data import GroupEntry, ContactsFeed
 from gdata.contacts.client import ContactsQuery
 
+def batch_controller(contacts_client):
+    """The AdaptiveController shared by all batches of a Contacts client, configured by options()."""
+    if getattr(contacts_client, 'batch_controller', None) is None:
+        contacts_client.batch_controller = AdaptiveController(batch_max=options().batch_max,
+            batch_min=options().batch_min,
+            target_latency=options().batch_target_latency,
+            backoff_max=options().backoff_max,
+            max_retries=options().max_retries)
+    return contacts_client.batch_controller
+
+def contacts_batch(contacts_client, cls=ContactsFeed, hold=False):
+    """A Batch configured by options()."""
+    return Batch(contacts_client, cls, batch_max=options().batch_max, hold=hold,
+        submitter=getattr(contacts_client, 'submitter', None),
+        conflict_rounds=options().conflict_rounds, controller=batch_controller(contacts_client),
+        progress=getattr(contacts_client, 'batch_progress', None))
+
+@contextmanager
+def submitting(contacts_client):
+    """Submits the batch feeds of contacts_client on one background thread in the block, with options().batch_pipeline."""
+    if int(options().batch_pipeline or 0) <= 0:
+        yield
+        return
+    contacts_client.submitter = Submitter(int(options().batch_pipeline))
+    try:
+        yield
+    finally:
+        contacts_client.submitter.close()
+        contacts_client.submitter = None
+
 def get_magic_group(groups):
     return next(iter(filter(is_script_group, groups)), None)
 
+def iter_feed(client, feed):
+    """Yields the entries of feed and of the pages following it, one page at a time."""
+    while feed is not None:
+        for entry in feed.entry:
+            yield entry
+        feed = client.get_next(feed) if feed.find_next_link() else None
+
+class FeedStream(object):
+    """Entries of a paged feed. `updated` is the server time of its first page."""
+    def __init__(self, client, feed):
+        self.client = client
+        self.feed = feed
+        self.updated = feed.updated.text if feed is not None and feed.updated else None
+    def __iter__(self):
+        return iter_feed(self.client, self.feed)
+
+def page_size():
+    """Contacts fetched per request, from max_contacts in configs older than page_size."""
+    return getattr(options(), 'page_size', None) or options().max_contacts
+
+def get_contacts(contacts_client, contacts_query=None):
+    """Contacts matching contacts_query, fetching page_size() per request."""
+    contacts_query = contacts_query or ContactsQuery()
+    contacts_query.max_results = page_size()
+    return FeedStream(contacts_client, contacts_client.get_contacts(q=contacts_query))
+
 def get_group_members(contacts_client, group):
     if not group:
-        return []
+        return FeedStream(contacts_client, None)
     contacts_query = ContactsQuery()
     contacts_query.group = group.id.text
-    contacts_query.max_results = options().max_contacts
-    return contacts_client.get_contacts(q=contacts_query).entry
+    return get_contacts(contacts_client, contacts_query)
+
+def get_changed_contacts(contacts_client, updated_min):
+    """Contacts updated since server time updated_min, including deleted ones."""
+    contacts_query = ContactsQuery(showdeleted='true')
+    contacts_query.updated_min = updated_min
+    return get_contacts(contacts_client, contacts_query)
+
+def is_member(contact, group):
+    return contact.deleted is None and any(
+        membership.href == group.id.text and membership.deleted != 'true'
+        for membership in contact.group_membership_info)
+
+class ChangedMembers(object):
+    """
+    Members of group that changed since the cache was saved. Contacts deleted or
+    removed from the group since are dropped from the cache. `updated` as in FeedStream.
+    """
+    def __init__(self, contacts_client, group, cache):
+        self.changes = get_changed_contacts(contacts_client, cache.updated)
+        self.updated = self.changes.updated
+        self.group = group
+        self.cache = cache
+    def __iter__(self):
+        for contact in self.changes:
+            if is_member(contact, self.group):
+                yield contact
+            else:
+                self.cache.discard(contact.id.text)
 
 def create_magic_group(contacts_client):
     logging.info('Creating magic group: {}'.format(options().group))
@@ -33,6 +124,52 @@ def create_magic_group(contacts_client):
 
     return contacts_client.create_group(new_group=new_group)
 
+def is_up_to_date(group, fingerprint, updated):
+    """Whether the group was stamped with fingerprint and has not been modified since it was last seen as `updated`."""
+    return bool(fingerprint and updated) \
+        and get_extended_property(group, options().group_fingerprint_extended_property_name) == fingerprint \
+        and group.updated is not None and group.updated.text == updated
+
+def stamp_magic_group(contacts_client, group, fingerprint):
+    """Records the fingerprint of the desired group contents on the group. Returns the group as stored."""
+    name = options().group_fingerprint_extended_property_name
+    if get_extended_property(group, name) == fingerprint:
+        return group
+    set_extended_property(group, name, fingerprint)
+    return contacts_client.update(group)
+
+def add_digest(template, fields):
+    """
+    Stamps a contact template with the digest of fields, the values of the fields copied
+    to existing contacts, so that contacts carrying the same digest need not be compared.
+    """
+    template.extended_property.append(ExtendedProperty(name=options().contact_digest_extended_property_name,
+        value=record_digest(fields)))
+
+def is_in_sync(contact, template, cache):
+    """
+    Whether contact needs no comparison with template: it carries the digest of template and
+    has not been modified since the previous run cached it (e.g. by its owner, whose edits
+    of the copied fields are to be reverted). Never without a cache.
+    """
+    name = options().contact_digest_extended_property_name
+    return cache is not None and cache.is_unmodified(contact) \
+        and get_extended_property(contact, name) == get_extended_property(template, name)
+
+def stamp_digest(contact, template, modified):
+    """
+    Stamps contact with the digest of template unless it carries it already. Contacts without
+    a digest are stamped by full runs, or along with a change, so that incremental runs do not
+    update them all at once. Returns whether contact was modified.
+    """
+    name = options().contact_digest_extended_property_name
+    digest = get_extended_property(template, name)
+    current = get_extended_property(contact, name)
+    if current == digest or not (modified or current or not options().incremental):
+        return modified
+    set_extended_property(contact, name, digest)
+    return True
+
 def is_script_contact(contact):
     return any(filter(
         lambda prop: prop.name == options().contact_extended_property_name \
@@ -45,36 +182,129 @@ def is_script_group(group):
                 and prop.value == options().group_extended_property_value,
         group.extended_property))
 
+def get_extended_property(entry, name):
+    return next(iter([prop.value for prop in entry.extended_property if prop.name == name]), None)
+
+def set_extended_property(entry, name, value):
+    entry.extended_property = [prop for prop in entry.extended_property if prop.name != name]
+    entry.extended_property.append(ExtendedProperty(name=name, value=value))
+
+def contact_emails(contact):
+    return [email.address.lower() for email in contact.email if email.address]
+
+class ContactIndex(object):
+    """
+    IDs of the group members of one target user, by key (e.g. LDAP ID) and by
+    lower-case email address. Only IDs are kept, so the members themselves can be
+    streamed through the sync phases.
+    """
+    def __init__(self):
+        self.by_id = {}
+        self.by_email = {}
+        self.ids = set()
+        self.count = 0
+    def add(self, contact, key=None):
+        self.add_cached(contact.id.text, key, contact_emails(contact))
+    def add_cached(self, contact_id, key, emails):
+        self.count += 1
+        self.ids.add(contact_id)
+        if key:
+            self.by_id[key] = contact_id
+        for email in emails:
+            self.by_email[email] = contact_id
+    def __len__(self):
+        return self.count
+
+def get_cached_members(contacts_client, cache, index, records):
+    """
+    Yields the cached group members that are not in index yet (i.e. did not change since the
+    previous run) and were synced to another source record than the current one in records,
+    fetching them again. The other cached members are only added to index.
+    """
+    stale_ids = []
+    for contact_id, (etag, key, emails, digest) in cache.contacts.items():
+        if contact_id in index.ids:
+            continue
+        if key and digest != records.get(key):
+            stale_ids.append(contact_id)
+        else:
+            index.add_cached(contact_id, key, emails)
+    for contact in query_contacts(contacts_client, stale_ids, options().batch_max):
+        yield contact
+
 def is_renamed_contact(contact):
     return any(filter(
         lambda prop: prop.name == options().contact_renamed_extended_property_name \
                 and prop.value == options().contact_renamed_extended_property_value,
         contact.extended_property))
 
-def undo(contacts_client, target_user, feed):
-    removed_ids = set()
+def delete_script_contacts(contacts_client, target_user, feed, list_contacts):
+    """
+    Deletes the script contacts among list_contacts() while paging through them. Deleting shifts
+    the pages still to come, so they are listed again until a pass finds none it could delete.
+    """
+    while True:
+        found = 0
+        with closing(contacts_batch(contacts_client, feed)) as batch:
+            for contact in ifilter(is_script_contact, list_contacts()):
+                logging.info('%s: Removing auto-generated contact "%s" with ID %s',
+                        target_user, contact.name.full_name.text, contact.id.text)
+                found += 1
+                batch.put('add_delete', contact)
+        if found == batch.failed:
+            return
 
-    contacts = contacts_client.get_contacts().entry
+def undo(contacts_client, target_user, feed):
+    delete_script_contacts(contacts_client, target_user, feed, lambda: get_contacts(contacts_client))
 
-    with closing(Batch(contacts_client, feed)) as batch:
-        for contact in filter(is_script_contact, contacts):
-            logging.info('%s: Removing auto-generated contact "%s" with ID %s',
-                    target_user, contact.name.full_name.text, contact.id.text)
-            removed_ids.add(contact.id.text)
-            batch.put('add_delete', contact)
-    
     # Get Contact groups
     groups = contacts_client.get_groups().entry
     magic_group = get_magic_group(groups)
     if magic_group:
-        with closing(Batch(contacts_client, feed)) as batch:
-            for group_member in filter(is_script_contact, get_group_members(contacts_client, magic_group)):
-                if group_member.id.text not in removed_ids:
-                    logging.info('%s: Removing auto-generated contact "%s" with ID %s',
-                        target_user, group_member.name.full_name.text, group_member.id.text)
-                    batch.put('add_delete', group_member)
+        delete_script_contacts(contacts_client, target_user, feed, lambda: get_group_members(contacts_client, magic_group))
 
         # Remove group
         contacts_client.delete_group(magic_group)
         logging.info('%s: Removing auto-generated group "%s" with ID %s',
                 target_user, magic_group.title.text, magic_group.id.text)
+
+def process_targets(targets, process, delta, journal_key, sharding, job):
+    """
+    Runs process(target, journal) for the targets of this shard on options().workers threads,
+    within the deadline and skipping those an interrupted run with the same journal_key
+    completed. Then saves the snapshot of delta and the run report. Returns (results, failures).
+    """
+    metrics = run_metrics()
+    # With a deadline, start with the target users most in need of a sync, and only as many as there is time for
+    scheduler = Scheduler(parse_deadline(options().deadline))
+    if scheduler.deadline and delta:
+        targets = prioritize(targets, delta)
+
+    # With --resume, skip the target users an interrupted run with the same sources and settings completed
+    journal = RunJournal(fileloc(options().journal_file), journal_key, resume=options().resume)
+    results, failures = run_sharded(sharding,
+        scheduler.track(metrics.track(journal.track(lambda target: process(target, journal)))),
+        journal.pending(targets),
+        workers=options().workers)
+    journal.close(finished=not failures)
+    scheduler.log_summary()
+    results.update(journal.completed)
+
+    if failures:
+        logging.error('Processing failed for %d user(s): %s', len(failures), ', '.join(failures))
+
+    if delta and not options().undo:
+        with metrics.phase('snapshot'):
+            delta.save(results)
+
+    logging.info('HTTP connections: %(opened)d opened, %(reused)d reused', get_pool(options()).stats())
+    for api, stats in sorted(get_limiter(options()).stats().items()):
+        logging.info('%s: %d requests, %d throttled for %.1fs by rate limits',
+            api, stats['requests'], stats['throttled'], stats['throttled_seconds'])
+    save_report(metrics, fileloc(options().report_file) if options().report_file else '',
+        fileloc(options().prometheus_file) if options().prometheus_file else '',
+        job=job,
+        completed=[target for target in results if target not in scheduler.deferred],
+        failed=failures, deferred=scheduler.deferred,
+        http_connections=get_pool(options()).stats(), rate_limits=get_limiter(options()).stats())
+    return results, failures
@@ -0,0 +1,91 @@
+import os
+import json
+import logging
+import threading
+
+"""
+Progress of a run, appended as one JSON object per line and synced to disk, so that
+an interrupted run can be resumed:
+{"run": key}                                   first line, identifies the run
+{"target": email, "batches": n, "failed": n}   after every batch feed submitted for a target
+{"target": email, "done": result}              after a target has been processed without failures
+A run that was started with other sources or settings (another key) is not resumed.
+"""
+
+def read_journal(path):
+    """The lines of a journal, as far as they could be parsed."""
+    entries = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break # torn last line of a crashed run
+    except IOError:
+        pass
+    return entries
+
+class RunJournal(object):
+    """
+    Journal of the run identified by key. With resume=True a journal left by an
+    interrupted run with the same key is continued, otherwise a new one is started.
+    """
+    def __init__(self, path, key, resume=False):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        self.completed = {}
+        self.batches = {}
+        entries = read_journal(path) if resume else []
+        if entries and entries[0].get('run') == key:
+            for entry in entries[1:]:
+                if 'done' in entry:
+                    self.completed[entry['target']] = entry['done']
+                elif 'batches' in entry:
+                    self.batches[entry['target']] = entry['batches']
+            logging.info('Resuming run: %d target(s) already completed', len(self.completed))
+            self.file = open(path, 'a')
+        else:
+            if resume and entries:
+                logging.info('Not resuming, the journal in %s is of a run with other sources or settings', path)
+            self.file = open(path, 'w')
+            self.write({'run': key})
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    def pending(self, targets):
+        """The targets that are not completed yet."""
+        return [target for target in targets if target not in self.completed]
+    def progress(self, target):
+        """Callback recording the batch feeds submitted for target, see Batch."""
+        if self.batches.get(target):
+            logging.info('%s: Resuming after %d batch(es) submitted by the interrupted run', target, self.batches[target])
+        counts = {'batches': self.batches.get(target, 0), 'failed': 0}
+        def submitted(operations, failed):
+            counts['batches'] += 1
+            counts['failed'] += failed
+            self.write({'target': target, 'batches': counts['batches'], 'failed': counts['failed']})
+        return submitted
+    def track(self, fn):
+        """
+        fn(target), recording every target it returns a result for as completed. None stands
+        for a target with failed operations, which stays pending for a resumed run.
+        """
+        def wrapper(target):
+            result = fn(target)
+            if result is not None:
+                self.done(target, result)
+            return result
+        return wrapper
+    def done(self, target, result):
+        self.write({'target': target, 'done': result})
+        with self.lock:
+            self.completed[target] = result
+    def close(self, finished=False):
+        """Closes the journal. A finished run removes it, there is nothing left to resume."""
+        self.file.close()
+        if finished:
+            os.remove(self.path)
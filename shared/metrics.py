@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from kids.cache import cache
+
+"""
+Instrumentation of a run: where the time went by phase, in total and per target user,
+the requests to every API with their latencies, the sizes of the batch feeds and the
+outcomes of their operations. Written at the end of a run as a JSON report and, for
+node_exporter's textfile collector, in the Prometheus text format.
+
+Phases nest: the time of a phase excludes that of the phases started within it, e.g.
+"submit" is not counted in the "diff" that filled the batch. Phases on other threads
+(pipelined batch feeds, parallel target users) overlap, so the phases add up to more
+than the duration of the run.
+"""
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# operation types of batch results by outcome
+OUTCOMES = {'insert': 'inserted', 'update': 'updated', 'delete': 'deleted'}
+
+_local = threading.local()
+
+def current_target():
+    """The target user the calling thread is processing, to be shared with threads it starts."""
+    return getattr(_local, 'target', None)
+
+def adopt_target(target):
+    """Accounts what the calling thread does to target, e.g. in the thread that started it."""
+    _local.target = target
+
+def phase_stack():
+    if getattr(_local, 'phases', None) is None:
+        _local.phases = []
+    return _local.phases
+
+@contextmanager
+def nothing():
+    yield
+
+def new_phase_counts():
+    return {'count': 0, 'seconds': 0.0}
+
+def new_target_counts():
+    return {'seconds': 0.0, 'phases': {}, 'requests': 0, 'outcomes': {}}
+
+def new_api_counts():
+    return {'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+        'buckets': [0] * len(LATENCY_BUCKETS)}
+
+class RunMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiler = None # told about phases and target users, see shared.profiling
+        self.start()
+    def start(self):
+        """Forgets everything recorded so far, e.g. by a previous run in the same process."""
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}
+            self.targets = {}
+            self.apis = {}
+            self.batches = {'feeds': 0, 'operations': 0, 'max_size': 0}
+            self.outcomes = {}
+    def target_counts(self, target):
+        return self.targets.setdefault(target, new_target_counts())
+    def track(self, fn):
+        """fn(target), accounting what it does to target."""
+        def wrapper(target):
+            previous = current_target()
+            adopt_target(target)
+            started = time.time()
+            try:
+                with self.profiled('target', target):
+                    return fn(target)
+            finally:
+                with self.lock:
+                    self.target_counts(target)['seconds'] += time.time() - started
+                adopt_target(previous)
+        return wrapper
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block as phase name, of the current target user if any."""
+        stack = phase_stack()
+        # [name, started, seconds spent in phases nested in it]
+        frame = [name, time.time(), 0.0]
+        stack.append(frame)
+        try:
+            with self.profiled('phase', name):
+                yield
+        finally:
+            stack.pop()
+            elapsed = time.time() - frame[1]
+            if stack:
+                stack[-1][2] += elapsed
+            self.add_phase(name, elapsed - frame[2])
+    def profiled(self, kind, name):
+        """The context of the profiler, if any, for a phase or target user."""
+        return getattr(self.profiler, kind)(name) if self.profiler else nothing()
+    def add_phase(self, name, seconds):
+        target = current_target()
+        with self.lock:
+            counts = [self.phases.setdefault(name, new_phase_counts())]
+            if target is not None:
+                counts.append(self.target_counts(target)['phases'].setdefault(name, new_phase_counts()))
+            for phase_counts in counts:
+                phase_counts['count'] += 1
+                phase_counts['seconds'] += seconds
+    def timed(self, name, iterable):
+        """Yields from iterable, timing the fetching of every item as phase name, e.g. of a paged feed."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    def request(self, api, status, seconds):
+        """Records a request to api, answered with status (None if there was no answer) in seconds."""
+        target = current_target()
+        with self.lock:
+            counts = self.apis.setdefault(api, new_api_counts())
+            counts['requests'] += 1
+            counts['errors'] += status is None or status >= 400
+            counts['seconds'] += seconds
+            counts['max_seconds'] = max(counts['max_seconds'], seconds)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    counts['buckets'][index] += 1
+                    break
+            if target is not None:
+                self.target_counts(target)['requests'] += 1
+    def observer(self, api):
+        """request() for the requests of one client, see PooledHttp."""
+        return lambda status, seconds: self.request(api, status, seconds)
+    def batch(self, operations):
+        """Records a batch feed of `operations` operations."""
+        with self.lock:
+            self.batches['feeds'] += 1
+            self.batches['operations'] += operations
+            self.batches['max_size'] = max(self.batches['max_size'], operations)
+    def outcome(self, name, count=1):
+        """Counts operations with outcome name: inserted, updated, deleted, renamed, conflicted or failed."""
+        if not count:
+            return
+        target = current_target()
+        with self.lock:
+            self.outcomes[name] = self.outcomes.get(name, 0) + count
+            if target is not None:
+                outcomes = self.target_counts(target)['outcomes']
+                outcomes[name] = outcomes.get(name, 0) + count
+    def report(self, **extra):
+        """The run report as a dict, with extra items added."""
+        with self.lock:
+            report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'seconds': time.time() - self.started,
+                'phases': self.phases,
+                'apis': dict((api, dict(counts, buckets=dict(zip(map(str, LATENCY_BUCKETS), counts['buckets']))))
+                    for api, counts in self.apis.iteritems()),
+                'batches': self.batches,
+                'outcomes': self.outcomes,
+                'targets': self.targets}
+            report.update(extra)
+            return json.loads(json.dumps(report))
+
+def write_file(path, content):
+    """Replaces the file at path at once, so that readers never see it half written."""
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.rename(path + '.tmp', path)
+
+def write_report(path, report):
+    write_file(path, json.dumps(report, indent=1, sort_keys=True) + '\n')
+
+def prometheus_labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(labels.items()))
+
+def prometheus_text(report, job):
+    """The totals of a run report in the Prometheus text format, labelled with the copier job."""
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append('# HELP copier_%s %s' % (name, help))
+        lines.append('# TYPE copier_%s %s' % (name, kind))
+        for labels, value in samples:
+            lines.append('copier_%s%s %s' % (name, prometheus_labels(copier=job, **labels), repr(float(value))))
+    metric('last_run_timestamp_seconds', 'gauge', 'Time the run finished.', [({}, time.time())])
+    metric('run_duration_seconds', 'gauge', 'Duration of the run.', [({}, report['seconds'])])
+    metric('target_users', 'gauge', 'Target users by outcome of the run.',
+        [({'outcome': key}, len(report.get(key, []))) for key in ['completed', 'failed', 'deferred']])
+    metric('phase_seconds', 'gauge', 'Time spent in each phase.',
+        [({'phase': name}, counts['seconds']) for name, counts in sorted(report['phases'].items())])
+    metric('api_requests_total', 'gauge', 'Requests to each API.',
+        [({'api': api}, counts['requests']) for api, counts in sorted(report['apis'].items())])
+    metric('api_errors_total', 'gauge', 'Requests to each API that failed.',
+        [({'api': api}, counts['errors']) for api, counts in sorted(report['apis'].items())])
+    samples = []
+    for api, counts in sorted(report['apis'].items()):
+        cumulative = 0
+        for bound in LATENCY_BUCKETS:
+            cumulative += counts['buckets'][str(bound)]
+            samples.append(({'api': api, 'le': bound}, cumulative))
+        samples.append(({'api': api, 'le': '+Inf'}, counts['requests']))
+    lines.append('# HELP copier_api_latency_seconds Latency of the requests to each API.')
+    lines.append('# TYPE copier_api_latency_seconds histogram')
+    for labels, value in samples:
+        lines.append('copier_api_latency_seconds_bucket%s %s' % (prometheus_labels(copier=job, **labels), repr(float(value))))
+    for api, counts in sorted(report['apis'].items()):
+        lines.append('copier_api_latency_seconds_sum%s %s' % (prometheus_labels(copier=job, api=api), repr(counts['seconds'])))
+        lines.append('copier_api_latency_seconds_count%s %s' % (prometheus_labels(copier=job, api=api), repr(float(counts['requests']))))
+    metric('batch_feeds_total', 'gauge', 'Batch feeds submitted.', [({}, report['batches']['feeds'])])
+    metric('batch_operations_total', 'gauge', 'Operations in the batch feeds submitted.', [({}, report['batches']['operations'])])
+    metric('operations_total', 'gauge', 'Contact operations by outcome.',
+        [({'outcome': name}, count) for name, count in sorted(report['outcomes'].items())])
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path, report, job):
+    write_file(path, prometheus_text(report, job))
+
+def save_report(metrics, report_file='', prometheus_file='', job='', **extra):
+    """Logs where the time went and writes the run report to the files given. Returns the report."""
+    report = metrics.report(job=job, **extra)
+    logging.info('Time by phase: %s', ', '.join('%s %.1fs' % (name, counts['seconds'])
+        for name, counts in sorted(report['phases'].items(), key=lambda item: -item[1]['seconds'])))
+    if report_file:
+        write_report(report_file, report)
+    if prometheus_file:
+        write_prometheus(prometheus_file, report, job)
+    return report
+
+@cache
+def run_metrics():
+    """The process-wide metrics."""
+    return RunMetrics()
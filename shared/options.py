@@ -5,6 +5,31 @@ from importlib import import_module
 from shared.files import fileloc
 from kids.cache import cache
 
+# Settings added after the first release, so that configs written before them keep working
+DEFAULTS = {
+    'http_pool_size': '10',
+    'rate_limits': 'admin=20, contacts=0/10',
+    'rate_limit_file': '',
+    'discovery_cache_dir': 'discovery_cache',
+    'discovery_cache_max_age': '86400',
+    'snapshot_file': 'snapshot.json.gz',
+    'contact_cache_dir': 'contact_cache',
+    'journal_file': 'journal.json',
+    'report_file': 'report.json',
+    'prometheus_file': '',
+    'lease_dir': '',
+    'lease_window': '60',
+    'batch_min': '10',
+    'batch_target_latency': '5',
+    'batch_pipeline': '2',
+    'conflict_rounds': '3',
+    'max_retries': '5',
+    'backoff_max': '60',
+    'group_fingerprint_extended_property_name': 'com.futurice.dircopier.fingerprint',
+    'contact_digest_extended_property_name': 'com.futurice.dircopier.digest',
+    'token_cache_file': '',
+}
+
 def provided_arguments(parser):
     p = vars(parser.parse_args())
     o = []
@@ -24,8 +49,12 @@ def options():
     config = ConfigParser.SafeConfigParser()
     config.read(fileloc(o.config))
 
+    # defaults of settings missing from the config
+    keys = sorted(DEFAULTS)
+    for key in keys:
+        setattr(o, key, DEFAULTS[key])
+
     # parse config in-order
-    keys = []
     for section in config.sections():
         for param in config.options(section):
             keys.append(param)
@@ -0,0 +1,73 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+
+_local = threading.local()
+
+class CaptureFilter(logging.Filter):
+    """Holds back records logged by a worker thread so they can be replayed in order."""
+    def filter(self, record):
+        records = getattr(_local, 'records', None)
+        if records is None:
+            return True
+        # the same record passes every root handler; keep it once
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
+
+_capture_filter = CaptureFilter()
+
+def install_capture():
+    for handler in logging.getLogger().handlers:
+        if _capture_filter not in handler.filters:
+            handler.addFilter(_capture_filter)
+
+def current_capture():
+    """The records list of the calling thread, None if its records are not captured."""
+    return getattr(_local, 'records', None)
+
+def adopt_capture(records):
+    """Captures the records of the calling thread into records, e.g. to be added to those of another thread."""
+    _local.records = records
+
+def replay(records):
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+def isolated(fn):
+    """Runs fn(item) capturing its log records and exception instead of letting them escape."""
+    def wrapper(item):
+        _local.records = []
+        try:
+            return item, fn(item), None, _local.records
+        except Exception as e:
+            logging.exception('%s: Processing failed', item)
+            return item, None, e, _local.records
+        finally:
+            _local.records = None
+    return wrapper
+
+def run_pool(fn, items, workers=1):
+    """Calls fn for each item on at most `workers` threads.
+
+    A failing item is logged and skipped, it does not abort the others. Log output
+    of every item is emitted as one block, in the order of `items`.
+    Returns (results, failures): an OrderedDict item -> return value and a list of failed items.
+    """
+    workers = max(1, int(workers or 1))
+    results = OrderedDict()
+    failures = []
+    install_capture()
+    pool = ThreadPool(workers)
+    try:
+        for item, result, error, records in pool.imap(isolated(fn), items):
+            replay(records)
+            if error is None:
+                results[item] = result
+            else:
+                failures.append(item)
+    finally:
+        pool.close()
+        pool.join()
+    return results, failures
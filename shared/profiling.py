@@ -0,0 +1,248 @@
+import os
+import gc
+import sys
+import json
+import time
+import pstats
+import logging
+import cProfile
+import resource
+import threading
+import Queue
+import multiprocessing.pool
+from StringIO import StringIO
+from collections import Counter
+from contextlib import contextmanager
+
+"""
+Profiling a run with --profile DIR, written to DIR when the run ends:
+cpu.prof      cProfile statistics of all target users and the main thread, for pstats or snakeviz
+cpu.txt       functions by own and by cumulative time as measured by cProfile, waits included
+wall.folded   stacks of all threads sampled every SAMPLE_INTERVAL seconds, for flamegraph.pl
+wall.txt      functions by samples, i.e. wall-clock time including waits for the network
+memory.json   resident memory (and the most common objects) after the major phases and every target user
+summary.txt   the top hot spots of each of the above
+Python 2 has no tracemalloc, memory is followed by resident set size and live objects by type.
+Threads other than the main thread and those processing target users (e.g. pipelined batch
+submits) only show up in the wall-clock samples.
+"""
+SAMPLE_INTERVAL = 0.005
+MAX_STACK_DEPTH = 100
+# phases (see shared.metrics) after which memory is recorded, with live objects for those mapped to True
+MEMORY_PHASES = {'directory': True, 'templates': True, 'submit': False, 'snapshot': False}
+TOP = 25
+
+def module_path(filename):
+    """Full path of a module file without extension, the same for its .py and .pyc."""
+    return os.path.splitext(os.path.realpath(filename))[0]
+
+# samples of threads waiting in these stdlib modules (for work, or the thread pool handlers) are idle time,
+# left out of the hot spots; matched by full path, shared/pool.py is not multiprocessing/pool.py
+IDLE_FILES = set(module_path(module.__file__) for module in [threading, Queue, multiprocessing.pool])
+
+_local = threading.local()
+_idle_files = {}
+
+def is_idle_file(filename):
+    """Whether code of filename is one of the IDLE_FILES."""
+    if filename not in _idle_files:
+        _idle_files[filename] = module_path(filename) in IDLE_FILES
+    return _idle_files[filename]
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+def frame_stack(frame):
+    """Names of the frames of a stack, outermost first."""
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(frame_name(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+def resident_kb():
+    """Current resident set size, the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def object_counts(top=TOP):
+    """The most common types of live objects tracked by the garbage collector, with their counts."""
+    return Counter(type(obj).__name__ for obj in gc.get_objects()).most_common(top)
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of all other threads every `interval` seconds."""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super(StackSampler, self).__init__(name='profiler')
+        self.daemon = True
+        self.interval = interval
+        self.stacks = Counter()
+        self.idle = set()
+        self.samples = 0
+        self.stopped = threading.Event()
+    def run(self):
+        own = threading.current_thread().ident
+        while not self.stopped.is_set():
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stack = (names.get(ident, 'thread'),) + frame_stack(frame)
+                    self.stacks[stack] += 1
+                    if is_idle_file(frame.f_code.co_filename):
+                        self.idle.add(stack)
+            self.samples += 1
+            self.stopped.wait(self.interval)
+    def stop(self):
+        self.stopped.set()
+        self.join()
+    def folded(self):
+        """Stacks in the collapsed format of flamegraph.pl, one "frame;frame;... count" per line."""
+        return ''.join('%s %d\n' % (';'.join(stack), count) for stack, count in sorted(self.stacks.items()))
+    def hot_spots(self):
+        """(own samples by function, samples by function anywhere on the stack) of the busy stacks."""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.iteritems():
+            if stack in self.idle:
+                continue
+            leaf = stack[-1]
+            own[leaf] += count
+            for name in set(stack[1:]):
+                total[name] += count
+        return own, total
+
+class Profiler(object):
+    """Collects the profiles of a run, see the module documentation. Told about phases and target users by RunMetrics."""
+    def __init__(self, directory, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.sampler = StackSampler(interval)
+        self.profile = cProfile.Profile()
+        self.target_profiles = []
+        self.memory = []
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.started = time.time()
+        self.record_memory('start', objects=True)
+        self.sampler.start()
+        _local.profile = self.profile
+        self.profile.enable()
+    def stop(self):
+        """Stops profiling and writes the profiles."""
+        self.profile.disable()
+        _local.profile = None
+        self.sampler.stop()
+        self.record_memory('end', objects=True)
+        self.write()
+        logging.info('Profile written to %s', self.directory)
+    def record_memory(self, label, objects=False):
+        snapshot = {'label': label, 'seconds': time.time() - self.started, 'rss_kb': resident_kb(),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        if objects:
+            snapshot['objects'] = object_counts()
+        with self.lock:
+            self.memory.append(snapshot)
+    @contextmanager
+    def phase(self, name):
+        yield
+        if name in MEMORY_PHASES:
+            self.record_memory(name, objects=MEMORY_PHASES[name])
+    @contextmanager
+    def target(self, target):
+        """Profiles processing target on the calling thread, unless it is being profiled already."""
+        if getattr(_local, 'profile', None) is not None:
+            yield
+            self.record_memory(target)
+            return
+        profile = _local.profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            _local.profile = None
+            with self.lock:
+                self.target_profiles.append(profile)
+            self.record_memory(target)
+    def stats(self):
+        stats = pstats.Stats(self.profile)
+        for profile in self.target_profiles:
+            stats.add(profile)
+        return stats
+    def write(self):
+        stats = self.stats()
+        stats.dump_stats(self.path('cpu.prof'))
+        cpu = self.cpu_text(stats)
+        write(self.path('cpu.txt'), cpu)
+        write(self.path('wall.folded'), self.sampler.folded())
+        wall = self.wall_text()
+        write(self.path('wall.txt'), wall)
+        with open(self.path('memory.json'), 'w') as f:
+            json.dump(self.memory, f, indent=1)
+        write(self.path('summary.txt'), '\n'.join([
+            'Run of %.1fs, %d wall-clock samples' % (time.time() - self.started, self.sampler.samples), '',
+            head(cpu, TOP + 10), '', head(wall, TOP + 2), '', self.memory_text()]))
+    def path(self, name):
+        return os.path.join(self.directory, name)
+    def cpu_text(self, stats):
+        out = StringIO()
+        stats.stream = out
+        for key in ['tottime', 'cumulative']:
+            out.write('cProfile, functions by %s\n' % {'tottime': 'own time', 'cumulative': 'cumulative time'}[key])
+            stats.sort_stats(key).print_stats(TOP)
+        return out.getvalue()
+    def wall_text(self):
+        own, total = self.sampler.hot_spots()
+        samples = float(max(self.sampler.samples, 1))
+        lines = ['Wall-clock time by function (%.0fms per sample, idle threads left out)' % (self.sampler.interval * 1000),
+            '%10s %10s  %s' % ('own s', 'total s', 'function')]
+        for name, count in own.most_common(TOP):
+            lines.append('%10.2f %10.2f  %s' % (count * self.sampler.interval, total[name] * self.sampler.interval, name))
+        lines.append('')
+        lines.append('By samples anywhere on the stack')
+        for name, count in total.most_common(TOP):
+            lines.append('%10.1f%%  %s' % (count * 100 / samples, name))
+        return '\n'.join(lines) + '\n'
+    def memory_text(self):
+        lines = ['Resident memory (kB) after']
+        repeated = {}
+        for snapshot in self.memory:
+            label = snapshot['label']
+            if 'objects' in snapshot:
+                lines.append('%10d  %s at %.1fs' % (snapshot['rss_kb'], label, snapshot['seconds']))
+            else:
+                kind = label if label in MEMORY_PHASES else 'a target user'
+                if snapshot['rss_kb'] > repeated.get(kind, {'rss_kb': -1})['rss_kb']:
+                    repeated[kind] = snapshot
+        for kind, snapshot in sorted(repeated.items()):
+            lines.append('%10d  the most after %s (%s at %.1fs)' % (snapshot['rss_kb'], kind, snapshot['label'], snapshot['seconds']))
+        lines.append('Most common objects at the end: %s' % ', '.join('%s %d' % (name, count)
+            for name, count in self.memory[-1]['objects'][:10]))
+        return '\n'.join(lines) + '\n'
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+def head(text, lines):
+    return '\n'.join(text.split('\n')[:lines])
+
+@contextmanager
+def profiling(directory, metrics):
+    """Profiles the enclosed block into directory, see the module documentation. Nothing without a directory."""
+    if not directory:
+        yield
+        return
+    profiler = Profiler(directory)
+    metrics.profiler = profiler
+    profiler.start()
+    try:
+        yield
+    finally:
+        metrics.profiler = None
+        profiler.stop()
@@ -0,0 +1,82 @@
+import re
+import time
+import logging
+import datetime
+import threading
+
+"""
+Fitting a run into its cron window: target users are processed in order of priority
+and no target user is started unless it is expected to finish before the deadline.
+Deferred target users are left out of the snapshot, so the next run takes them first.
+"""
+# a target user is started only if this many average durations fit before the deadline
+SAFETY_FACTOR = 1.5
+
+def parse_deadline(value, now=None):
+    """
+    Deadline as a timestamp, from 'HH:MM' (the next time the clock shows it)
+    or a number of minutes from now. None without a value.
+    """
+    if not value:
+        return None
+    now = now or time.time()
+    match = re.match(r'^(\d{1,2}):(\d{2})$', value.strip())
+    if not match:
+        return now + float(value) * 60
+    start = datetime.datetime.fromtimestamp(now)
+    deadline = start.replace(hour=int(match.group(1)), minute=int(match.group(2)), second=0, microsecond=0)
+    if deadline <= start:
+        deadline += datetime.timedelta(days=1)
+    return time.mktime(deadline.timetuple())
+
+def prioritize(targets, delta):
+    """
+    Targets never synced by a completed run first (new, failed or deferred last time), then those
+    whose sources changed since (see shared.snapshot.Delta), then the others. Within each tier
+    by the time their group was last synced, the longest ago first.
+    """
+    def priority(target):
+        changed_keys = delta.changed_keys(target)
+        return (changed_keys is not None, not (changed_keys or delta.removed), delta.group_stamp(target))
+    return sorted(targets, key=priority)
+
+class Scheduler(object):
+    """Admits target users while they are expected to finish before deadline (a timestamp, or None)."""
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.busy = 0.0
+        self.deferred = []
+    def average(self):
+        """Average duration of processing a target user so far, None before the first one is done."""
+        return self.busy / self.completed if self.completed else None
+    def admit(self, target):
+        if self.deadline is None:
+            return True
+        with self.lock:
+            average = self.average() or 0.0
+            if time.time() + average * SAFETY_FACTOR < self.deadline:
+                return True
+            if not self.deferred:
+                logging.warn('Deadline %s is near, deferring the remaining target users to the next run',
+                    time.strftime('%H:%M', time.localtime(self.deadline)))
+            self.deferred.append(target)
+            return False
+    def track(self, fn):
+        """fn(target) for the admitted targets, None for the deferred ones."""
+        def wrapper(target):
+            if not self.admit(target):
+                return None
+            started = time.time()
+            result = fn(target)
+            with self.lock:
+                self.completed += 1
+                self.busy += time.time() - started
+            return result
+        return wrapper
+    def log_summary(self):
+        elapsed = time.time() - self.started
+        logging.info('Processed %d target user(s) in %.0fs (%.1f per minute), %d deferred to the next run',
+            self.completed, elapsed, self.completed * 60.0 / max(elapsed, 1.0), len(self.deferred))
@@ -0,0 +1,117 @@
+import os
+import time
+import fcntl
+import hashlib
+import logging
+from collections import OrderedDict
+
+from shared.pool import run_pool
+
+"""
+Splitting the target users of a run between hosts: with --shard i/N a host syncs the
+target users whose email hashes to shard i (0 <= i < N). With a lease directory shared
+by the hosts, a host holds a lock on its shard while syncing it and marks it done after,
+unless syncing a target user failed. Hosts that are done take over the shards of hosts
+that did not run, i.e. shards that are neither locked nor marked done in the current
+window. Windows are `window` minutes long, starting at midnight: the hosts of a run agree
+on its window as long as they are started together, once per window (e.g. by cron).
+"""
+
+def parse_shard(spec):
+    """(index, count) from 'i/N', (0, 1) without a spec."""
+    if not spec:
+        return 0, 1
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise ValueError('Shard %s is not of the form i/N' % spec)
+    if not 0 <= index < count:
+        raise ValueError('Shard %s is not one of 0/%d to %d/%d' % (spec, count, count - 1, count))
+    return index, count
+
+def shard_of(email, count):
+    """Shard of a target user, the same on every host and in every run."""
+    return int(hashlib.sha1(email.lower().encode('utf-8')).hexdigest(), 16) % count
+
+def window_start(window, now=None):
+    """Start of the window of `window` minutes that now falls in, as local 'YYYY-MM-DDTHH:MM'."""
+    now = now or time.time()
+    midnight = time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1))
+    seconds = max(1, int(float(window) * 60))
+    return time.strftime('%Y-%m-%dT%H:%M', time.localtime(midnight + (now - midnight) // seconds * seconds))
+
+class Sharding(object):
+    def __init__(self, spec='', lease_dir='', window=60):
+        self.index, self.count = parse_shard(spec)
+        self.lease_dir = lease_dir
+        self.window = window_start(window)
+        self.locks = {}
+    def select(self, targets, shard):
+        if self.count == 1:
+            return list(targets)
+        return [target for target in targets if shard_of(target, self.count) == shard]
+    def path(self, shard, suffix):
+        return os.path.join(self.lease_dir, 'shard-%d-of-%d.%s' % (shard, self.count, suffix))
+    def acquire(self, shard):
+        """Locks shard without waiting, False if another host holds it."""
+        f = open(self.path(shard, 'lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+        self.locks[shard] = f
+        return True
+    def release(self, shard):
+        self.locks.pop(shard).close()
+    def is_done(self, shard):
+        """Whether shard was synced without failures in the current window."""
+        try:
+            with open(self.path(shard, 'done')) as f:
+                return f.read().strip() == self.window
+        except IOError:
+            return False
+    def mark_done(self, shard):
+        """Records that shard was synced in the current window, to be called while it is claimed."""
+        if self.lease_dir:
+            with open(self.path(shard, 'done'), 'w') as f:
+                f.write(self.window + '\n')
+    def claim(self):
+        """Yields the shards for this host to sync, locked: its own, then those taken over.
+        Shards marked done in the current window are skipped, the own one included."""
+        if not self.lease_dir:
+            yield self.index
+            return
+        if not os.path.isdir(self.lease_dir):
+            os.makedirs(self.lease_dir)
+        for shard in [self.index] + [shard for shard in range(self.count) if shard != self.index]:
+            if self.is_done(shard):
+                if shard == self.index:
+                    logging.info('Shard %d/%d has already been synced by another host', shard, self.count)
+                continue
+            if not self.acquire(shard):
+                logging.info('Shard %d/%d is being synced by another host', shard, self.count)
+                continue
+            try:
+                if self.is_done(shard):
+                    continue
+                if shard != self.index:
+                    logging.warn('Taking over shard %d/%d, no other host has synced it', shard, self.count)
+                yield shard
+            finally:
+                self.release(shard)
+
+def run_sharded(sharding, fn, items, workers=1):
+    """run_pool() over the items in the shards claimed by this host."""
+    results = OrderedDict()
+    failures = []
+    for shard in sharding.claim():
+        shard_items = sharding.select(items, shard)
+        if sharding.count > 1:
+            logging.info('Syncing shard %d/%d: %d target user(s)', shard, sharding.count, len(shard_items))
+        shard_results, shard_failures = run_pool(fn, shard_items, workers)
+        if not shard_failures:
+            sharding.mark_done(shard)
+        results.update(shard_results)
+        failures.extend(shard_failures)
+    return results, failures
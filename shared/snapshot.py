@@ -0,0 +1,81 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+from contextlib import closing
+
+"""
+Source records seen by the previous run, stored as gzipped JSON:
+{"version": 2, "salt": "...", "records": {key: digest}, "targets": {email: group updated stamp}}
+A snapshot of another version or salt (settings that change the contacts) is ignored.
+"""
+SNAPSHOT_VERSION = 2
+
+def record_digest(record):
+    """Content hash of a JSON serializable record."""
+    return hashlib.sha1(json.dumps(record, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+def empty_snapshot(salt=''):
+    return {'version': SNAPSHOT_VERSION, 'salt': salt, 'records': {}, 'targets': {}}
+
+def read_json(path):
+    """Contents of a gzipped JSON file, or None if it is missing or unreadable."""
+    try:
+        with closing(gzip.open(path, 'rb')) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logging.info('No usable state in %s (%s)', path, e)
+        return None
+
+def write_json(path, data):
+    """Replaces a gzipped JSON file atomically."""
+    tmp_path = path + '.tmp'
+    with closing(gzip.open(tmp_path, 'wb')) as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.rename(tmp_path, path)
+
+def load_snapshot(path, salt=''):
+    snapshot = read_json(path)
+    if snapshot is None:
+        return empty_snapshot(salt)
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('salt') != salt:
+        logging.info('Ignoring snapshot in %s made with other settings', path)
+        return empty_snapshot(salt)
+    return snapshot
+
+def save_snapshot(path, snapshot):
+    write_json(path, snapshot)
+
+def diff_records(old, new):
+    """Keys added, changed and removed between two {key: digest} dicts."""
+    added = set(new) - set(old)
+    removed = set(old) - set(new)
+    changed = set(key for key in new if key in old and new[key] != old[key])
+    return added, changed, removed
+
+class Delta(object):
+    """Source records changed since the previous run, and the target users that run completed."""
+    def __init__(self, path, records, salt=''):
+        self.path = path
+        self.salt = salt
+        self.snapshot = load_snapshot(path, salt)
+        self.records = records
+        self.added, self.changed, self.removed = diff_records(self.snapshot['records'], records)
+        self.synced_targets = self.snapshot['targets']
+        # desired state of every target user's group
+        self.fingerprint = record_digest([salt, sorted(records.items())])
+    def changed_keys(self, target):
+        """Keys whose contacts need a full diff for target, or None if everything does."""
+        if target not in self.synced_targets:
+            return None
+        return self.added | self.changed
+    def group_stamp(self, target):
+        """Updated stamp of the target's group as left by the previous run."""
+        return self.synced_targets.get(target)
+    def save(self, completed_targets):
+        """Stores the records with {target: group updated stamp} of the targets synced without errors."""
+        snapshot = empty_snapshot(self.salt)
+        snapshot['records'] = self.records
+        snapshot['targets'] = dict((target, stamp) for target, stamp in completed_targets.iteritems() if stamp)
+        save_snapshot(self.path, snapshot)
@@ -0,0 +1,169 @@
+import os
+import json
+import errno
+import socket
+import time
+import fcntl
+import random
+import logging
+import threading
+
+import httplib2
+
+"""
+Request pacing for the Contacts API
+"""
+# HTTP statuses of requests (or batch operations) worth repeating later
+RETRY_STATUSES = set([429, 500, 502, 503, 504])
+
+def is_retryable(status, reason=''):
+    """Rate limits and server errors, including quota errors reported as 403."""
+    reason = (reason or '').lower()
+    return status in RETRY_STATUSES or (status == 403 and ('quota' in reason or 'rate' in reason))
+
+def was_not_sent(error):
+    """Whether a request failed before it reached the server: unknown host or connection refused."""
+    return isinstance(error, httplib2.ServerNotFoundError) or \
+        (isinstance(error, socket.error) and error.errno == errno.ECONNREFUSED)
+
+class AdaptiveController(object):
+    """
+    Batch size and pause between the batch requests of one client. The size grows
+    while requests are quick and succeed, shrinks when they get slow, and is halved
+    together with a doubled pause when requests are throttled. Backoff delays grow
+    exponentially per attempt, with jitter so that workers do not retry in lockstep.
+    """
+    def __init__(self, batch_max=100, batch_min=10, target_latency=5.0,
+            backoff_base=1.0, backoff_max=60.0, max_retries=5):
+        self.batch_max = int(batch_max)
+        self.batch_min = min(int(batch_min), self.batch_max)
+        self.size = self.batch_max
+        self.target_latency = float(target_latency)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.max_retries = int(max_retries)
+        self.delay = 0.0
+    def wait(self):
+        """Pauses before the next request, if requests have been throttled lately."""
+        if self.delay:
+            time.sleep(self.delay)
+    def succeeded(self, latency):
+        if latency > self.target_latency:
+            self.size = max(self.batch_min, int(self.size * 0.75))
+        else:
+            self.size = min(self.batch_max, self.size + max(1, self.batch_max // 10))
+        self.delay = self.delay / 2 if self.delay > 0.1 else 0.0
+    def throttled(self, attempt):
+        """Adapts to a throttled request and returns how long to wait before attempt + 1."""
+        self.size = max(self.batch_min, self.size // 2)
+        self.delay = min(self.backoff_max, max(self.backoff_base, self.delay * 2))
+        return random.uniform(0.5, 1.0) * min(self.backoff_max, self.backoff_base * 2 ** attempt)
+    def backoff(self, attempt, what):
+        delay = self.throttled(attempt)
+        logging.warn('%s, retrying in %.1fs (batch size now %d)', what, delay, self.size)
+        time.sleep(delay)
+
+def parse_rate_limits(spec):
+    """
+    {api: (project QPS, per user QPS)} from 'api=project[/user], ...', e.g.
+    'admin=20, contacts=0/10'. A rate of 0 means no limit.
+    """
+    limits = {}
+    for item in (spec or '').replace(',', ' ').split():
+        api, rates = item.split('=', 1)
+        rates = [float(rate) for rate in rates.split('/')]
+        limits[api] = (rates[0], rates[1] if len(rates) > 1 else 0.0)
+    return limits
+
+class TokenBucket(object):
+    """
+    `rate` requests per second, in bursts of at most `burst` requests. Tokens are
+    reserved ahead of time, so that concurrent callers queue up in order.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+    def take(self, tokens, stamp, now):
+        """(tokens, stamp) after taking one, and how long to wait for it."""
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate) - 1
+        return tokens, now, max(0.0, -tokens / self.rate)
+    def reserve(self):
+        """Takes a token, returns how long to wait until it is due."""
+        with self.lock:
+            self.tokens, self.stamp, wait = self.take(self.tokens, self.stamp, time.time())
+            return wait
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket kept in a file under `key`, shared by every process using the same file."""
+    def __init__(self, path, key, rate, burst=None):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+        self.key = key
+    def reserve(self):
+        with self.lock:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try: buckets = json.load(f)
+                    except ValueError: buckets = {}
+                    now = time.time()
+                    tokens, stamp = buckets.get(self.key, (self.burst, now))
+                    tokens, stamp, wait = self.take(tokens, stamp, now)
+                    buckets[self.key] = (tokens, stamp)
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(buckets, f)
+                    f.flush()
+                    return wait
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+class RateLimiter(object):
+    """
+    Token buckets per API for the whole project and per (API, impersonated user),
+    with limits as returned by parse_rate_limits(). With shared_file the buckets
+    are shared with other processes on the host.
+    """
+    def __init__(self, limits, shared_file=''):
+        self.limits = limits
+        self.shared_file = shared_file
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.counts = {}
+    def bucket(self, key, rate):
+        with self.lock:
+            if key not in self.buckets:
+                if self.shared_file:
+                    self.buckets[key] = SharedTokenBucket(self.shared_file, '/'.join(key), rate)
+                else:
+                    self.buckets[key] = TokenBucket(rate)
+            return self.buckets[key]
+    def acquire(self, api, user=None):
+        """Waits until a request to api on behalf of user is within the limits."""
+        project_rate, user_rate = self.limits.get(api, (0, 0))
+        wait = 0.0
+        if project_rate:
+            wait = max(wait, self.bucket((api,), project_rate).reserve())
+        if user_rate and user:
+            wait = max(wait, self.bucket((api, user), user_rate).reserve())
+        self.count(api, wait)
+        if wait:
+            time.sleep(wait)
+    def bind(self, api, user=None):
+        """acquire() for the requests of one client."""
+        return lambda: self.acquire(api, user)
+    def count(self, api, wait):
+        with self.lock:
+            counts = self.counts.setdefault(api, {'requests': 0, 'throttled': 0, 'throttled_seconds': 0.0})
+            counts['requests'] += 1
+            if wait:
+                counts['throttled'] += 1
+                counts['throttled_seconds'] += wait
+    def stats(self):
+        """{api: {'requests', 'throttled' (requests that waited), 'throttled_seconds'}}"""
+        with self.lock:
+            return dict((api, dict(counts)) for api, counts in self.counts.iteritems())
@@ -0,0 +1,136 @@
+import time
+import threading
+from StringIO import StringIO
+
+import httplib2
+
+"""
+Keep-alive HTTP connections shared by the GData and Discovery API clients of the process.
+"""
+
+def connection_key(uri):
+    """The key under which httplib2 keeps the connection used for uri."""
+    scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+    return scheme + ':' + authority
+
+class ConnectionPool(object):
+    """
+    Every request borrows one of at most `size` httplib2.Http instances, each of
+    which keeps a persistent connection per host. Idle instances already connected
+    to the host of the request are preferred, so that connections get reused.
+    """
+    def __init__(self, size=10, timeout=None):
+        self.size = int(size)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.opened = 0
+        self.reused = 0
+    def checkout(self, key):
+        with self.lock:
+            for index in reversed(range(len(self.idle))):
+                if key in self.idle[index].connections:
+                    return self.idle.pop(index)
+            if self.idle:
+                return self.idle.pop()
+        return httplib2.Http(timeout=self.timeout)
+    def checkin(self, http, reused):
+        with self.lock:
+            self.idle.append(http)
+            if reused:
+                self.reused += 1
+            else:
+                self.opened += 1
+    def request(self, uri, method='GET', body=None, headers=None, follow_redirects=True, **kwargs):
+        """httplib2.Http.request through a pooled connection."""
+        key = connection_key(uri)
+        with self.slots:
+            http = self.checkout(key)
+            connection = http.connections.get(key)
+            try:
+                http.follow_redirects = follow_redirects
+                return http.request(uri, method, body=body, headers=headers, **kwargs)
+            finally:
+                self.checkin(http, connection is not None and http.connections.get(key) is connection)
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def connection_pool(size=10):
+    """The process-wide pool, of the size given by the first call."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(size)
+        return _pool
+
+class PooledHttp(object):
+    """
+    httplib2.Http look-alike for Discovery API clients, sending requests through a pool.
+    limit() is called before every request, e.g. to wait for a rate limiter, and
+    observe(status, seconds) after it, with status None if the request failed.
+    """
+    def __init__(self, pool, limit=None, observe=None):
+        self.pool = pool
+        self.limit = limit
+        self.observe = observe
+    def request(self, uri, method='GET', body=None, headers=None,
+            redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        if self.limit:
+            self.limit()
+        return observed(self.observe, lambda: self.pool.request(uri, method, body=body, headers=headers, redirections=redirections))
+
+def observed(observe, request):
+    """request(), reporting the status of its response and how long it took to observe if given."""
+    if not observe:
+        return request()
+    started = time.time()
+    status = None
+    try:
+        response, content = request()
+        status = response.status
+        return response, content
+    finally:
+        observe(status, time.time() - started)
+
+class HttpResponse(object):
+    """The atom.http_core response interface over a httplib2 response."""
+    def __init__(self, response, content):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response
+        self.body = StringIO(content)
+    def read(self, amt=None):
+        return self.body.read() if amt is None else self.body.read(amt)
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+    def getheaders(self):
+        return self.headers.items()
+
+def body_string(part):
+    if hasattr(part, 'read'):
+        part = part.read()
+    if isinstance(part, unicode):
+        part = part.encode('utf-8')
+    return str(part)
+
+class PooledHttpClient(object):
+    """atom.http_core.HttpClient for GData clients, sending requests through a pool, see PooledHttp."""
+    debug = None
+    def __init__(self, pool, limit=None, observe=None):
+        self.pool = pool
+        self.limit = limit
+        self.observe = observe
+    def request(self, http_request):
+        if self.limit:
+            self.limit()
+        response, content = observed(self.observe, lambda: self.pool.request(str(http_request.uri),
+            http_request.method,
+            body=''.join(body_string(part) for part in http_request._body_parts) or None,
+            headers=http_request.headers,
+            follow_redirects=False)) # GData clients follow redirects themselves
+        return HttpResponse(response, content)
+    Request = request